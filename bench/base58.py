@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#
+# Base58(check) codec: table/chunk based versions in base58.py against the
+# simple ones they replaced (copied below as reference).
+#
+#   python3 bench/base58.py [-n 20000]
+#
+import sys, timeit, argparse
+from psbt_faker import SIM_XPUB
+from psbt_faker.base58 import (BASE58_ALPHABET, hash256, encode_base58, decode_base58,
+                               encode_base58_checksum, decode_base58_checksum)
+
+def old_encode_base58(data):
+    count = 0
+    for c in data:
+        if c == 0:
+            count += 1
+        else:
+            break
+    num = int.from_bytes(data, 'big')
+    prefix = '1' * count
+    result = ''
+    while num > 0:
+        num, mod = divmod(num, 58)
+        result = BASE58_ALPHABET[mod] + result
+    return prefix + result
+
+def old_decode_base58(s):
+    num = 0
+    for c in s:
+        if c not in BASE58_ALPHABET:
+            raise ValueError(c)
+        num *= 58
+        num += BASE58_ALPHABET.index(c)
+
+    h = hex(num)[2:]
+    h = '0' + h if len(h) % 2 else h
+    res = bytes.fromhex(h)
+
+    pad = 0
+    for c in s[:-1]:
+        if c == BASE58_ALPHABET[0]:
+            pad += 1
+        else:
+            break
+    return b'\x00' * pad + res
+
+def old_encode_base58_checksum(data):
+    return old_encode_base58(data + hash256(data)[:4])
+
+def old_decode_base58_checksum(s):
+    raw = old_decode_base58(s)
+    assert hash256(raw[:-4])[:4] == raw[-4:]
+    return raw[:-4]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', type=int, default=20000, help="iterations per measurement")
+    args = ap.parse_args()
+    n = args.n
+
+    def run(label, old, new):
+        assert old() == new()
+        t_old = min(timeit.repeat(old, number=n, repeat=3)) / n
+        t_new = min(timeit.repeat(new, number=n, repeat=3)) / n
+        print(f"{label:36s} {t_old*1e6:8.2f}us {t_new*1e6:8.2f}us {t_old/t_new:6.1f}x")
+
+    p2pkh = bytes([0]) + bytes(range(1, 21))            # version + hash160
+    xpub = decode_base58_checksum(SIM_XPUB)             # 78 bytes
+
+    print(f"{'':36s} {'old':>10s} {'now':>10s} {'gain':>7s}")
+    run("encode_base58_checksum(p2pkh)",
+        lambda: old_encode_base58_checksum(p2pkh), lambda: encode_base58_checksum(p2pkh))
+    run("encode_base58_checksum(xpub)",
+        lambda: old_encode_base58_checksum(xpub), lambda: encode_base58_checksum(xpub))
+
+    addr = encode_base58_checksum(p2pkh)
+    run("decode_base58_checksum(p2pkh)",
+        lambda: old_decode_base58_checksum(addr), lambda: decode_base58_checksum(addr))
+    run("decode_base58_checksum(xpub)",
+        lambda: old_decode_base58_checksum(SIM_XPUB), lambda: decode_base58_checksum(SIM_XPUB))
+
+    big = bytes(range(256)) * 4
+    run("encode_base58(1KiB)", lambda: old_encode_base58(big), lambda: encode_base58(big))
+    enc = encode_base58(big)
+    run("decode_base58(1KiB)", lambda: old_decode_base58(enc), lambda: decode_base58(enc))
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# EOF
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+# Compact size codec: table/int.from_bytes based versions in serialize.py against
+# the struct based ones they replaced (copied below as reference).
+#
+#   python3 bench/compact_size.py [-n 200000]
+#
+import io, sys, struct, timeit, argparse
+from psbt_faker.serialize import ser_compact_size, deser_compact_size, deser_compact_size_from
+
+def old_ser_compact_size(size):
+    r = b""
+    if size < 253:
+        r = struct.pack("B", size)
+    elif size < 0x10000:
+        r = struct.pack("<BH", 253, size)
+    elif size < 0x100000000:
+        r = struct.pack("<BI", 254, size)
+    else:
+        r = struct.pack("<BQ", 255, size)
+    return r
+
+def old_deser_compact_size(f):
+    try:
+        nit = struct.unpack("<B", f.read(1))[0]
+    except struct.error:
+        return None
+
+    if nit == 253:
+        nit = struct.unpack("<H", f.read(2))[0]
+    elif nit == 254:
+        nit = struct.unpack("<I", f.read(4))[0]
+    elif nit == 255:
+        nit = struct.unpack("<Q", f.read(8))[0]
+    return nit
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', type=int, default=200000, help="iterations per measurement")
+    args = ap.parse_args()
+    n = args.n
+
+    def run(label, old, new):
+        t_old = min(timeit.repeat(old, number=n, repeat=3)) / n
+        t_new = min(timeit.repeat(new, number=n, repeat=3)) / n
+        print(f"{label:42s} {t_old*1e9:8.0f}ns {t_new*1e9:8.0f}ns {t_old/t_new:6.1f}x")
+
+    print(f"{'':42s} {'struct':>10s} {'now':>10s} {'gain':>7s}")
+    for v in (33, 300, 70000):
+        run(f"ser_compact_size({v})", lambda: old_ser_compact_size(v), lambda: ser_compact_size(v))
+
+    for v in (33, 300):
+        enc = ser_compact_size(v)
+        fd = io.BytesIO(enc)
+
+        def old():
+            fd.seek(0)
+            old_deser_compact_size(fd)
+
+        def new():
+            fd.seek(0)
+            deser_compact_size(fd)
+
+        run(f"deser_compact_size({v})", old, new)
+        run(f"deser_compact_size_from({v}) vs stream", old, lambda: deser_compact_size_from(enc, 0))
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# EOF
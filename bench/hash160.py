@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+#
+# Compare RIPEMD-160 backends behind helpers.hash160(), per hash and per address made.
+#
+#   python3 bench/hash160.py [-n 2000]
+#
+import sys, timeit, argparse
+from psbt_faker import helpers, SIM_XPUB
+from psbt_faker.bip32 import BIP32Node
+from psbt_faker.txn import make_change_addr
+from psbt_faker.wallet import WalletContext
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', type=int, default=2000, help="iterations per measurement")
+    args = ap.parse_args()
+
+    sec = bytes.fromhex('02' + '11' * 32)
+    account_key = BIP32Node.from_wallet_key(SIM_XPUB)
+    # derive once, so only address building (mostly hashing) is measured
+    dest = account_key.subkey_for_path("0/0")
+    pubkey = dest.node.public_key
+
+    results = {}
+    for name in helpers.ripemd160_backends():
+        helpers.set_ripemd160_backend(name)
+
+        t_hash = timeit.timeit(lambda: helpers.hash160(sec), number=args.n) / args.n
+        t_addr = timeit.timeit(lambda: pubkey.address(addr_fmt='p2sh-p2wpkh'),
+                               number=args.n) / args.n
+        results[name] = (t_hash, t_addr)
+
+    helpers.set_ripemd160_backend()
+
+    slowest = results['python']
+    print(f"{'backend':14s} {'hash160':>12s} {'p2sh-p2wpkh addr':>18s} {'speedup':>8s}")
+    for name, (t_hash, t_addr) in results.items():
+        print(f"{name:14s} {t_hash*1e6:10.2f}us {t_addr*1e6:16.2f}us {slowest[1]/t_addr:7.1f}x")
+
+    # whole change output, including the BIP32 derivation which hashing doesn't help
+    xfp = bytes.fromhex('0f056943')
+    t = timeit.timeit(lambda: make_change_addr(WalletContext(account_key, xfp), 5, 'p2wpkh-p2sh'),
+                      number=max(1, args.n // 20)) / max(1, args.n // 20)
+    print(f"\nmake_change_addr() with '{helpers.ripemd160_backend}': {t*1e6:.1f}us per address")
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# EOF
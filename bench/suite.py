@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Benchmark suite: PSBT generation, parsing, serialization and the crypto underneath.
+#
+#   python3 bench/suite.py [-k fake_txn] [--quick] [-o results.json]
+#   python3 bench/suite.py --compare baseline.json [--threshold 10]
+#   python3 bench/suite.py --load results.json --compare baseline.json
+#
+# Each case reports best time per call over a few repeats. Results are saved as
+# JSON; --compare flags cases that got slower than threshold percent against an
+# older result file, and exits with status 1 if any did.
+#
+import os, sys, gc, json, time, platform, argparse
+from psbt_faker import SIM_XPUB, ec, helpers
+from psbt_faker.bip32 import BIP32Node, HARDENED
+from psbt_faker.psbt import BasicPSBT
+from psbt_faker.txn import fake_txn, fake_ms_txn
+from psbt_faker.wallet import wallet_for
+from psbt_faker.multisig import from_simple_text
+from psbt_faker.segwit_addr import encode as bech32_encode, decode as bech32_decode
+from psbt_faker.base58 import encode_base58_checksum, decode_base58_checksum
+from psbt_faker.cache import CODE_VERSION
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MS_CONFIG = os.path.join(HERE, '..', 'ms-example-segwit.txt')
+
+def make_cases():
+    # [(name, fn, prepare)]: fn(arg) is timed, arg = prepare() made outside the timing
+    cases = []
+
+    def case(name, prepare=None):
+        def deco(fn):
+            cases.append((name, fn, prepare))
+            return fn
+        return deco
+
+    # generation; wallet keys get derived on first call and reused after,
+    # so this is the steady state of a batch (derivation is timed below)
+    for af, segwit, wrapped in [('p2pkh', False, False), ('p2wpkh', True, False),
+                                ('p2sh-p2wpkh', True, True)]:
+        wallet = wallet_for(SIM_XPUB, af=af, is_testnet=True)
+        for ins, outs in [(1, 2), (10, 10), (100, 20)]:
+            @case(f"fake_txn/{af}/{ins}x{outs}")
+            def _(arg, ins=ins, outs=outs, wallet=wallet, segwit=segwit, wrapped=wrapped):
+                fake_txn(ins, outs, segwit_in=segwit, wrapped=wrapped, outstyles=['p2wpkh'],
+                         change_outputs=[0], is_testnet=True, wallet=wallet, seed=1)
+
+    with open(MS_CONFIG, 'rt') as fd:
+        _, ms_af, keys, M, N = from_simple_text(fd.read().split("\n"))
+    for style in ('p2wsh', 'p2sh'):
+        for ins, outs in [(1, 2), (20, 10)]:
+            @case(f"fake_ms_txn/{style}/{ins}x{outs}")
+            def _(arg, ins=ins, outs=outs, style=style):
+                fake_ms_txn(ins, outs, M, keys, outstyles=[style], change_outputs=[0],
+                            change_af=ms_af, seed=1)
+
+    # parsing and serialization of a large PSBT
+    big_v0, _ = fake_txn(500, 50, segwit_in=True, change_outputs=[0], seed=1,
+                         wallet=wallet_for(SIM_XPUB, af='p2wpkh', is_testnet=True))
+    big_v2 = BasicPSBT().parse(big_v0).to_v2()
+    parsed = lambda raw: (lambda: BasicPSBT().parse(raw))
+
+    case("psbt/parse/500x50")(lambda arg: BasicPSBT().parse(big_v0))
+    case("psbt/parse-lazy/500x50")(lambda arg: BasicPSBT().parse(big_v0, lazy=True))
+    case("psbt/serialize/500x50", parsed(big_v0))(lambda psbt: psbt.as_bytes())
+    case("psbt/to_v2/500x50", parsed(big_v0))(lambda psbt: psbt.to_v2())
+    case("psbt/to_v0/500x50", parsed(big_v2))(lambda psbt: psbt.to_v0())
+
+    # BIP-32, on whichever EC backend is active
+    pub = BIP32Node.from_hwif(SIM_XPUB).node
+    prv = BIP32Node.from_master_secret(b'1' * 32).node
+
+    case("bip32/parse-xpub")(lambda arg: BIP32Node.from_hwif(SIM_XPUB))
+    case("bip32/ckd-pub")(lambda arg: pub.ckd(7))
+    case("bip32/ckd-prv-hardened")(lambda arg: prv.ckd(HARDENED + 7).public_key.sec())
+    case("bip32/derive_children-pub/100")(lambda arg: pub.derive_children(0, 100))
+
+    # primitives
+    sec = bytes.fromhex('02' + '11' * 32)
+    h20, h32 = bytes(range(20)), bytes(range(32))
+    wpkh_addr = bech32_encode('bc', 0, h20)
+    b58_addr = encode_base58_checksum(b'\x00' + h20)
+
+    case("hash160")(lambda arg: helpers.hash160(sec))
+    case("bech32/encode-p2wpkh")(lambda arg: bech32_encode('bc', 0, h20))
+    case("bech32/encode-p2wsh-trusted")(lambda arg: bech32_encode('bc', 0, h32, trusted=True))
+    case("bech32/decode")(lambda arg: bech32_decode('bc', wpkh_addr))
+    case("base58/encode-check")(lambda arg: encode_base58_checksum(b'\x00' + h20))
+    case("base58/decode-check")(lambda arg: decode_base58_checksum(b58_addr))
+    case("base58/decode-xpub")(lambda arg: decode_base58_checksum(SIM_XPUB))
+
+    return cases
+
+def measure(fn, prepare, min_time, repeat):
+    # best seconds per call; calls per repeat grow until a repeat takes min_time
+    # - garbage collector is off while timing, same as timeit
+    gc_was_on = gc.isenabled()
+    gc.disable()
+    try:
+        return _measure(fn, prepare, min_time, repeat)
+    finally:
+        if gc_was_on:
+            gc.enable()
+
+def _measure(fn, prepare, min_time, repeat):
+    number = 1
+    while True:
+        t = run(fn, prepare, number)
+        if t >= min_time or number >= 1_000_000:
+            break
+        number *= 10 if t < min_time / 10 else 2
+
+    best = t
+    for _ in range(repeat - 1):
+        best = min(best, run(fn, prepare, number))
+    return best / number
+
+def run(fn, prepare, number):
+    if prepare is None:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn(None)
+        return time.perf_counter() - t0
+
+    total = 0.0
+    for _ in range(number):
+        arg = prepare()
+        t0 = time.perf_counter()
+        fn(arg)
+        total += time.perf_counter() - t0
+    return total
+
+def environment():
+    return dict(python=platform.python_version(), machine=platform.machine(),
+                ec_backend=ec.backend.name, ripemd160=helpers.ripemd160_backend,
+                code_version=CODE_VERSION[:16],
+                when=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+def compare(old, new, threshold):
+    # print old vs new per case; returns names of cases slower than threshold percent
+    slower = []
+    print(f"\n{'case':40s} {'before':>12s} {'after':>12s} {'change':>8s}")
+    for name, t_new in new['results'].items():
+        t_old = old['results'].get(name)
+        if t_old is None:
+            print(f"{name:40s} {'-':>12s} {fmt(t_new):>12s}      new")
+            continue
+        pct = (t_new / t_old - 1) * 100
+        flag = ''
+        if pct > threshold:
+            flag = '  REGRESSION'
+            slower.append(name)
+        print(f"{name:40s} {fmt(t_old):>12s} {fmt(t_new):>12s} {pct:+7.1f}%{flag}")
+
+    if old.get('env', {}).get('ec_backend') != new.get('env', {}).get('ec_backend'):
+        print("\nNote: EC backends differ (%s vs %s)" % (old.get('env', {}).get('ec_backend'),
+                                                        new['env']['ec_backend']))
+    return slower
+
+def fmt(secs):
+    if secs >= 1e-3:
+        return '%.2fms' % (secs * 1e3)
+    return '%.2fus' % (secs * 1e6)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-k', metavar='TEXT', action='append', help="only cases with TEXT in name (multiple ok)")
+    ap.add_argument('-r', '--repeat', type=int, default=5, help="repeats per case, best one counts")
+    ap.add_argument('--quick', action='store_true', help="shorter runs, less precise")
+    ap.add_argument('-o', '--output', metavar='FILE', help="save results as JSON")
+    ap.add_argument('--load', metavar='FILE', help="don't run, use results saved before")
+    ap.add_argument('--compare', metavar='FILE', help="compare with results saved before")
+    ap.add_argument('--threshold', type=float, default=10, help="percent slower that counts as regression (default 10)")
+    args = ap.parse_args()
+
+    if args.load:
+        with open(args.load, 'rt') as fd:
+            new = json.load(fd)
+    else:
+        min_time = 0.02 if args.quick else 0.2
+        new = dict(env=environment(), results={})
+        for name, fn, prepare in make_cases():
+            if args.k and not any(k in name for k in args.k):
+                continue
+            t = measure(fn, prepare, min_time, args.repeat)
+            new['results'][name] = t
+            print(f"{name:40s} {fmt(t):>12s}", flush=True)
+
+    if args.output:
+        with open(args.output, 'wt') as fd:
+            json.dump(new, fd, indent=2)
+            fd.write('\n')
+
+    if args.compare:
+        with open(args.compare, 'rt') as fd:
+            old = json.load(fd)
+        slower = compare(old, new, args.threshold)
+        if slower:
+            print(f"\n{len(slower)} case(s) more than {args.threshold:g}% slower")
+            return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# EOF
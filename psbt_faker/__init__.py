@@ -7,18 +7,51 @@
 # That will create the command "psbt_faker" in your path... or just use "./main.py ..." here
 #
 #
-import click
+import click, os, sys
+from contextlib import ExitStack
 from binascii import b2a_hex as _b2a_hex
-from base64 import b64encode
 from decimal import Decimal
 from .txn import fake_ms_txn, fake_txn, ADDR_STYLES
-from .multisig import from_simple_text
+from .batch import iter_fake_txns, iter_fake_ms_txns, write_batch
+from .batch import parallel_fake_txns, parallel_fake_ms_txns
+from .multisig import from_simple_text, MultisigAddressIndex
+from .cache import PSBTCache, DEFAULT_MAX_SIZE
+from . import ec, timing
 
 b2a_hex = lambda a: str(_b2a_hex(a), 'ascii')
 #xfp2hex = lambda a: b2a_hex(a[::-1]).upper()
 
 SIM_XPUB = 'tpubD6NzVbkrYhZ4XzL5Dhayo67Gorv1YMS7j8pRUvVMd5odC2LBPLAygka9p7748JtSq82FNGPppFEz5xxZUdasBRCqJqXvUHq6xpnsMcYJzeh'
 
+# --ec-backend and --ec-bench are handled before anything else (like --help), so
+# --ec-bench works without OUTPUT.PSBT. Whichever of the two comes second does the
+# benchmark, so it reports the backend picked, in any order on the command line.
+
+def _ec_backend_cb(ctx, param, value):
+    if value and not ctx.resilient_parsing:
+        try:
+            ec.set_backend(value)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), ctx, param)
+        # spawned worker processes pick it up from here
+        os.environ[ec.ENV_VAR] = value
+    if ctx.meta.get('ec_bench'):
+        _ec_bench(ctx)
+    return value
+
+def _ec_bench_cb(ctx, param, value):
+    if not value or ctx.resilient_parsing:
+        return
+    ctx.meta['ec_bench'] = True
+    if 'ec_backend' in ctx.params:
+        _ec_bench(ctx)
+
+def _ec_bench(ctx):
+    for name, secs in ec.self_benchmark().items():
+        print(f"{name:>12}: {secs * 1e6:9.1f} usec per derivation", file=sys.stderr)
+    print(ec.describe(), file=sys.stderr)
+    ctx.exit()
+
 
 @click.command()
 @click.argument('out_psbt', type=click.File('wb'), metavar="OUTPUT.PSBT")
@@ -39,10 +72,32 @@ SIM_XPUB = 'tpubD6NzVbkrYhZ4XzL5Dhayo67Gorv1YMS7j8pRUvVMd5odC2LBPLAygka9p7748JtS
 @click.option('--locktime', '-l', help="nLocktime value (default 0), use 'current' to fetch best block height from mempool.space", default="0")
 @click.option('--input-amount', '-n', help="Size of each input in sats (default 100k sats each input)", default=100000)
 @click.option('--incl-xpubs', '-I',  help="[MS] Include XPUBs in PSBT global section", is_flag=True, default=False)
+@click.option('--ms-index', type=click.Path(dir_okay=False), metavar="FILE", help="[MS] Address index file for the multisig wallet, made if missing and reused after", default=None)
+@click.option('--count', type=click.IntRange(min=1), help="Number of PSBT files to make (default 1), named after OUTPUT.PSBT", default=1)
+@click.option('--out-dir', type=click.Path(file_okay=False), metavar="DIR", help="Directory for the PSBT files when making more than one", default=None)
+@click.option('--workers', '-j', type=click.IntRange(min=0), help="With --count: number of processes to use (0 = all cores, default 1)", default=1)
+@click.option('--seed', type=int, help="Make reproducible output; same seed gives same PSBT files, regardless of --workers", default=None)
+@click.option('--cache-dir', type=click.Path(file_okay=False), metavar="DIR", help="Keep generated PSBTs here and reuse them on later runs (requires --seed)", default=None)
+@click.option('--cache-size', type=click.IntRange(min=1), metavar="MB", help="Size limit of --cache-dir, least recently used PSBTs are removed (default 512)", default=DEFAULT_MAX_SIZE // (1024 * 1024))
+@click.option('--ec-backend', type=click.Choice(list(ec.BACKENDS) + list(ec.ALIASES)), help=f"Elliptic curve library to use (default: fastest installed, or ${ec.ENV_VAR})", default=None, is_eager=True, callback=_ec_backend_cb)
+@click.option('--ec-bench', help="Time the installed elliptic curve libraries, show which one is used and exit", is_flag=True, default=False, is_eager=True, expose_value=False, callback=_ec_bench_cb)
+@click.option('--profile', help="Show where the time went: key parsing, derivation, hashing, writing...", is_flag=True, default=False)
+@click.option('--profile-dump', type=click.Path(dir_okay=False), metavar="FILE", help="Save full cProfile statistics into FILE (read with: python3 -m pstats FILE)", default=None)
 def main(num_ins, num_change, num_outs, out_psbt, testnet, xpub, segwit, fee, styles, base64,
-         partial, zero_xfp, multisig, locktime, input_amount, psbt2, incl_xpubs, wrapped):
+         partial, zero_xfp, multisig, locktime, input_amount, psbt2, incl_xpubs, wrapped,
+         count, out_dir, workers, seed, cache_dir, cache_size, ms_index, ec_backend, profile,
+         profile_dump):
     '''Construct a valid PSBT which spends non-existant BTC to random addresses!'''
 
+    if profile or profile_dump:
+        # report comes out when click is done with us, whichever way we return
+        stack = ExitStack()
+        stack.enter_context(timing.profiling(profile, profile_dump))
+        click.get_current_context().call_on_close(stack.close)
+
+    if not ec.backend.native:
+        print(ec.describe(), file=sys.stderr)
+
     if locktime == "current":
         try:
             import urllib.request
@@ -53,25 +108,69 @@ def main(num_ins, num_change, num_outs, out_psbt, testnet, xpub, segwit, fee, st
     else:
         locktime = int(locktime)
 
+    timing.active.lap('setup')
+
+    parallel = (count > 1 and workers != 1)
+
     if multisig:
         ms_config = multisig.read()
         name, af, keys, M, N = from_simple_text(ms_config.split("\n"))
-        psbt, outs = fake_ms_txn(num_ins, num_outs, M, keys, fee=fee, locktime=locktime,
-                                 change_outputs=list(range(num_change)), outstyles=styles,
-                                 input_amount=input_amount, psbt_v2=psbt2, change_af=af,
-                                 incl_xpubs=incl_xpubs, is_testnet=testnet)
+        timing.active.lap('parse keys')
+
+        gen = parallel_fake_ms_txns if parallel else iter_fake_ms_txns
+        args = (num_ins, num_outs, M, keys)
+        kws = dict(fee=fee, locktime=locktime,
+                   change_outputs=list(range(num_change)), outstyles=styles,
+                   input_amount=input_amount, psbt_v2=psbt2, change_af=af,
+                   incl_xpubs=incl_xpubs, is_testnet=testnet)
+
+        if ms_index:
+            # inputs use change addresses 1/0.., change outputs follow them on 0/*
+            kws['addr_index'] = MultisigAddressIndex.open(ms_index, M, keys, af,
+                                                          count=num_ins + num_outs)
+            timing.active.lap('ms index')
     else:
         if zero_xfp:
             xpub = None
 
-        psbt, outs = fake_txn(num_ins, num_outs, master_xpub=xpub, fee=fee,
-                              segwit_in=segwit, outstyles=styles, locktime=locktime,
-                              partial=partial, is_testnet=testnet, wrapped=wrapped,
-                              change_outputs=list(range(num_change)),
-                              psbt_v2=psbt2, input_amount=input_amount)
+        gen = parallel_fake_txns if parallel else iter_fake_txns
+        args = (num_ins, num_outs)
+        kws = dict(master_xpub=xpub, fee=fee,
+                   segwit_in=segwit, outstyles=styles, locktime=locktime,
+                   partial=partial, is_testnet=testnet, wrapped=wrapped,
+                   change_outputs=list(range(num_change)),
+                   psbt_v2=psbt2, input_amount=input_amount)
+
+    if parallel:
+        kws['workers'] = workers
+        if profile:
+            print("(--profile: time spent inside worker processes shows up as 'other')",
+                  file=sys.stderr)
 
+    kws['seed'] = seed
 
-    out_psbt.write(psbt if not base64 else b64encode(psbt))
+    if cache_dir:
+        if seed is None:
+            raise click.UsageError("--cache-dir requires --seed")
+        kws['cache'] = PSBTCache(cache_dir, max_size=cache_size * 1024 * 1024)
+
+    if count > 1 or out_dir:
+        # batch mode: OUTPUT.PSBT only provides the naming pattern
+        if out_psbt.name in ('-', '<stdout>'):
+            # stdout has no name to number: DIR/fake-0000.psbt ...
+            stem, suffix = 'fake', '.psbt'
+            out_dir = out_dir or '.'
+        else:
+            stem, suffix = os.path.splitext(os.path.basename(out_psbt.name))
+            out_dir = out_dir or os.path.dirname(out_psbt.name) or '.'
+        written = write_batch(out_dir, gen, count, *args, stem=stem, suffix=suffix or '.psbt',
+                              base64=base64, **kws)
+
+        print(f"\nWrote {len(written)} fake PSBT files: {written[0]} ... {written[-1]}", end='\n\n')
+        return
+
+    # PSBT is written into file while being built
+    _, outs = next(gen(1, *args, files=[out_psbt], base64=base64, **kws))
 
     print(f"\nFake PSBT would send {((num_ins*input_amount)/Decimal(1E8))} BTC to: ")
     print('\n'.join(" %.8f => %s %s" % (Decimal(amt)/Decimal(1E8),dest, ' (change back)' if chg else '')
@@ -79,6 +178,8 @@ def main(num_ins, num_change, num_outs, out_psbt, testnet, xpub, segwit, fee, st
     if fee:
         print(" %.8f => miners fee" % (Decimal(fee)/Decimal(1E8)))
 
+    timing.active.lap('render')
+
     print("\nPSBT to be signed: " + out_psbt.name, end='\n\n')
 
 
@@ -5,6 +5,16 @@ import hashlib
 
 BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
+# character -> digit value
+BASE58_INDEX = {c: i for i, c in enumerate(BASE58_ALPHABET)}
+
+# all 2-digit strings, so encoding takes one divmod per two characters
+_PAIRS = [a + b for a in BASE58_ALPHABET for b in BASE58_ALPHABET]
+
+# big numbers are converted CHUNK digits at a time (58**10 < 2**64)
+CHUNK = 10
+_CHUNK_BASE = 58 ** CHUNK
+
 
 def hash256(s: bytes) -> bytes:
     """
@@ -23,19 +33,24 @@ def encode_base58(data: bytes) -> str:
     :param data: data to encode
     :return: base58 encoded string
     """
-    count = 0
-    for c in data:
-        if c == 0:
-            count += 1
-        else:
-            break
+    count = len(data) - len(data.lstrip(b'\0'))
     num = int.from_bytes(data, 'big')
-    prefix = '1' * count
-    result = ''
-    while num > 0:
-        num, mod = divmod(num, 58)
-        result = BASE58_ALPHABET[mod] + result
-    return prefix + result
+
+    # digit pairs, least significant first
+    parts = []
+    while num >= _CHUNK_BASE:
+        num, rem = divmod(num, _CHUNK_BASE)
+        for _ in range(CHUNK // 2):
+            rem, mod = divmod(rem, 3364)
+            parts.append(_PAIRS[mod])
+    while num >= 58:
+        num, mod = divmod(num, 3364)
+        parts.append(_PAIRS[mod])
+
+    if num:
+        parts.append(BASE58_ALPHABET[num])
+
+    return '1' * count + ''.join(reversed(parts))
 
 
 def encode_base58_checksum(data: bytes) -> str:
@@ -55,18 +70,21 @@ def decode_base58(s: str) -> bytes:
     :param s: base58 encoded string
     :return: decoded data
     """
+    index = BASE58_INDEX
     num = 0
-    for c in s:
-        if c not in BASE58_ALPHABET:
-            raise ValueError(
-                "character {} is not valid base58 character".format(c)
-            )
-        num *= 58
-        num += BASE58_ALPHABET.index(c)
-
-    h = hex(num)[2:]
-    h = '0' + h if len(h) % 2 else h
-    res = bytes.fromhex(h)
+    for pos in range(0, len(s), CHUNK):
+        chunk = s[pos:pos + CHUNK]
+        v = 0
+        for c in chunk:
+            try:
+                v = v * 58 + index[c]
+            except KeyError:
+                raise ValueError(
+                    "character {} is not valid base58 character".format(c)
+                )
+        num = (num * (58 ** len(chunk))) + v
+
+    res = num.to_bytes(max(1, (num.bit_length() + 7) // 8), 'big')
 
     # Add padding back.
     pad = 0
@@ -0,0 +1,193 @@
+#
+# Batch generation: many PSBTs per invocation, with the key material parsed only once.
+#
+import os, random, hashlib, functools, tempfile, unittest, multiprocessing
+from unittest import mock
+from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor
+from .txn import fake_txn, fake_ms_txn, single_sig_af
+from .wallet import wallet_for
+from . import timing
+
+
+def job_seed(seed, n):
+    # seed for n-th PSBT of a batch; does not depend on which process (or machine) makes it
+    return int.from_bytes(hashlib.sha256(b'%d/%d' % (seed, n)).digest()[:8], 'big')
+
+def _single_sig_wallet(master_xpub, kws):
+    wallet = kws.pop('wallet', None)
+    if wallet is None:
+        af = single_sig_af(kws.get('segwit_in', False), kws.get('wrapped', False))
+        wallet = wallet_for(master_xpub, af=af, is_testnet=kws.get('is_testnet', False))
+    timing.active.lap('parse keys')
+    return wallet
+
+def _make_one(func, args, kws, dest=None, base64=False, cache=None):
+    # one PSBT: returned as bytes, or streamed into dest (filename or open binary file)
+    if cache is not None and isinstance(kws.get('seed'), int):
+        return _make_cached(cache, func, args, kws, dest, base64)
+
+    if dest is None:
+        return func(*args, **kws)
+
+    if isinstance(dest, str):
+        with open(dest, 'wb') as fd:
+            _, outs = _make_one(func, args, kws, fd, base64)
+        return dest, outs
+
+    # when profiling, time spent in write() is counted apart
+    fd = timing.active.wrap_file(dest)
+    if base64:
+        psbt, outs = func(*args, **kws)
+        fd.write(b64encode(psbt))
+    else:
+        _, outs = func(*args, out_fd=fd, **kws)
+
+    return dest, outs
+
+def _make_cached(cache, func, args, kws, dest=None, base64=False):
+    # same as _make_one, but PSBT comes from (or goes into) a PSBTCache
+    key = cache.key(func, args, kws)
+    hit = cache.get(key)
+    if hit:
+        psbt, outs = hit
+        timing.active.lap('cache')
+    else:
+        psbt, outs = func(*args, **kws)
+        cache.put(key, psbt, outs)
+
+    if dest is None:
+        return psbt, outs
+
+    data = b64encode(psbt) if base64 else psbt
+    if isinstance(dest, str):
+        with open(dest, 'wb') as fd:
+            timing.active.wrap_file(fd).write(data)
+    else:
+        timing.active.wrap_file(dest).write(data)
+    return dest, outs
+
+def _iter_jobs(count, seed, func, args, kws, files=None, base64=False, cache=None):
+    for n in range(count):
+        if seed is not None:
+            kws['seed'] = job_seed(seed, n)
+        yield _make_one(func, args, kws, files[n] if files else None, base64, cache)
+
+def iter_fake_txns(count, num_ins, num_outs, master_xpub=None, seed=None, files=None,
+                   base64=False, cache=None, **kws):
+    # yield (psbt, outs) for `count` single-signer PSBTs; same args as fake_txn()
+    # - with a seed, PSBT n is same as fake_txn(..., seed=job_seed(seed, n)), so output is
+    #   reproducible and matches parallel_fake_txns
+    # - with files (filenames or open files), each PSBT is streamed into its file
+    #   and (file, outs) is yielded instead
+    # - cache: a cache.PSBTCache, used when there is a seed
+    kws['wallet'] = _single_sig_wallet(master_xpub, kws)
+    return _iter_jobs(count, seed, fake_txn, (num_ins, num_outs), kws, files, base64, cache)
+
+def iter_fake_ms_txns(count, num_ins, num_outs, M, keys, seed=None, files=None,
+                      base64=False, cache=None, **kws):
+    # yield (psbt, outs) for `count` multisig PSBTs; same args as fake_ms_txn()
+    # - keys are already parsed, see multisig.from_simple_text()
+    # - seed, files and cache: see iter_fake_txns()
+    return _iter_jobs(count, seed, fake_ms_txn, (num_ins, num_outs, M, keys), kws,
+                      files, base64, cache)
+
+# Process pool version. Parsed keys and the other arguments are shipped to each
+# worker once (pool initializer), after that a job is just its seed and filename.
+_worker_job = None
+
+def _init_worker(func, args, kws, base64, cache):
+    global _worker_job
+    _worker_job = (func, args, kws, base64, cache)
+
+def _run_job(job):
+    func, args, kws, base64, cache = _worker_job
+    seed, fname = job
+    return _make_one(func, args, dict(kws, seed=seed), fname, base64, cache)
+
+def _parallel_jobs(count, seed, workers, func, args, kws, files=None, base64=False, cache=None):
+    if seed is None:
+        # workers would otherwise share the parent's random state and make duplicates
+        seed = random.SystemRandom().getrandbits(64)
+
+    workers = workers or os.cpu_count() or 1
+    jobs = [(job_seed(seed, n), files[n] if files else None) for n in range(count)]
+    chunksize = max(1, min(64, count // (workers * 4)))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(func, args, kws, base64, cache)) as pool:
+        # map() keeps job order, so files get same names as a serial build
+        yield from pool.map(_run_job, jobs, chunksize=chunksize)
+
+def parallel_fake_txns(count, num_ins, num_outs, master_xpub=None, seed=None, workers=None,
+                       files=None, base64=False, cache=None, **kws):
+    # like iter_fake_txns() but spread over a pool of processes (default: all cores)
+    # - files must be filenames here; workers write them directly
+    # - each worker has its own copy of cache, they all share its directory
+    kws['wallet'] = _single_sig_wallet(master_xpub, kws)
+    return _parallel_jobs(count, seed, workers, fake_txn, (num_ins, num_outs), kws,
+                          files, base64, cache)
+
+def parallel_fake_ms_txns(count, num_ins, num_outs, M, keys, seed=None, workers=None,
+                          files=None, base64=False, cache=None, **kws):
+    # like iter_fake_ms_txns() but spread over a pool of processes (default: all cores)
+    return _parallel_jobs(count, seed, workers, fake_ms_txn, (num_ins, num_outs, M, keys), kws,
+                          files, base64, cache)
+
+def batch_filenames(out_dir, count, stem='fake', suffix='.psbt'):
+    # filenames used for a batch: DIR/stem-0000.psbt ... (zero-padded so they sort)
+    width = max(4, len(str(count - 1)))
+    return [os.path.join(out_dir, f"{stem}-{n:0{width}d}{suffix}") for n in range(count)]
+
+def write_batch(out_dir, gen, count, *args, stem='fake', suffix='.psbt', **kws):
+    # make `count` PSBT files in out_dir, each streamed to disk as it is built
+    # - gen is one of the functions above, args/kws are passed along to it
+    # - returns list of filenames written
+    os.makedirs(out_dir, exist_ok=True)
+
+    files = batch_filenames(out_dir, count, stem, suffix)
+    return [fname for fname, _ in gen(count, *args, files=files, **kws)]
+
+
+class TestSeededBatch(unittest.TestCase):
+    # same seed, same PSBTs: serial, process pool (fork or spawn) and plain
+    # fake_txn(seed=job_seed(seed, n)) must agree byte for byte
+    #   python3 -m unittest psbt_faker.batch
+    SEED = 1234
+    COUNT = 5
+
+    def check(self, serial, parallel, func, args, kws):
+        want = [func(*args, seed=job_seed(self.SEED, n), **kws)
+                for n in range(self.COUNT)]
+        want = [(bytes(psbt), list(outs)) for psbt, outs in want]
+
+        got = serial(self.COUNT, *args, seed=self.SEED, **dict(kws))
+        self.assertEqual([(bytes(psbt), list(outs)) for psbt, outs in got], want)
+
+        got = parallel(self.COUNT, *args, seed=self.SEED, workers=2, **dict(kws))
+        self.assertEqual([(bytes(psbt), list(outs)) for psbt, outs in got], want)
+
+        # files, as the CLI makes them, with workers that start from scratch
+        spawn = functools.partial(ProcessPoolExecutor,
+                                  mp_context=multiprocessing.get_context('spawn'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = batch_filenames(tmpdir, self.COUNT)
+            with mock.patch(__name__ + '.ProcessPoolExecutor', spawn):
+                list(parallel(self.COUNT, *args, seed=self.SEED, workers=2, files=files,
+                              **dict(kws)))
+            for fname, (psbt, _) in zip(files, want):
+                with open(fname, 'rb') as fd:
+                    self.assertEqual(fd.read(), psbt)
+
+    def test_single_sig(self):
+        from . import SIM_XPUB
+        kws = dict(master_xpub=SIM_XPUB, segwit_in=True, change_outputs=[0], is_testnet=True)
+        self.check(iter_fake_txns, parallel_fake_txns, fake_txn, (2, 3), kws)
+
+    def test_multisig(self):
+        from .multisig import _test_wallet
+        af, keys, M = _test_wallet()
+        kws = dict(change_af=af, change_outputs=[0], outstyles=['p2tr', 'p2pkh'])
+        self.check(iter_fake_ms_txns, parallel_fake_ms_txns, fake_ms_txn, (2, 3, M, keys), kws)
+
+# EOF
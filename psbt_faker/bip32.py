@@ -1,21 +1,11 @@
 # (c) Copyright 2024 by Coinkite Inc. This file is covered by license found in COPYING-CC.
 #
-import hashlib, hmac
+import hashlib, hmac, unittest
 from typing import Union
 from io import BytesIO
-try:
-    from pysecp256k1 import (
-        ec_seckey_verify, ec_pubkey_create, ec_pubkey_serialize, ec_pubkey_parse,
-        ec_seckey_tweak_add, ec_pubkey_tweak_add,
-    )
-except ImportError:
-    import ecdsa
-    SECP256k1 = ecdsa.curves.SECP256k1
-    CURVE_GEN = ecdsa.ecdsa.generator_secp256k1
-    CURVE_ORDER = CURVE_GEN.order()
-    FIELD_ORDER = SECP256k1.curve.p()
-    INFINITY = ecdsa.ellipticcurve.INFINITY
+from collections import OrderedDict
 
+from . import ec
 from .segwit_addr import encode as bech32_encode
 from .base58 import encode_base58_checksum, decode_base58_checksum
 from .helpers import str2ipath, hash160
@@ -61,6 +51,25 @@ def hmac_sha512(key: bytes, msg: bytes) -> bytes:
     return hmac.new(key=key, msg=msg, digestmod=hashlib.sha512).digest()
 
 
+def hmac_sha512_many(key: bytes, prefix: bytes, suffixes) -> list:
+    """
+    HMAC-SHA512 of many messages sharing key and prefix. Key schedule and
+    prefix are hashed once, each message only continues from a copy.
+
+    :param key: secret key
+    :param prefix: common start of all messages
+    :param suffixes: iterable of message tails
+    :return: list of digests
+    """
+    template = hmac.new(key=key, msg=prefix, digestmod=hashlib.sha512)
+    rv = []
+    for suffix in suffixes:
+        h = template.copy()
+        h.update(suffix)
+        rv.append(h.digest())
+    return rv
+
+
 class PrivateKey(object):
 
     __slots__ = (
@@ -76,17 +85,10 @@ class PrivateKey(object):
         """
         if isinstance(sec_exp, int):
             sec_exp = int_to_big_endian(sec_exp, 32)
-        try:
-            ec_seckey_verify(sec_exp)
-            self.k = sec_exp
-            self.K = PublicKey(ec_pubkey_create(self.k))
-        except NameError:
-            k = ecdsa.SigningKey.from_string(sec_exp, curve=SECP256k1)
-            self.K = PublicKey(pub_key=k.get_verifying_key())
-            self.k = k.to_string()
-        else:
-            ec_seckey_verify(self.k)
-            self.K = PublicKey(ec_pubkey_create(self.k))
+        backend = ec.backend
+        backend.seckey_verify(sec_exp)
+        self.k = bytes(sec_exp)
+        self.K = PublicKey(backend.pubkey_create(self.k), backend)
 
     def __bytes__(self) -> bytes:
         """
@@ -117,7 +119,7 @@ class PrivateKey(object):
         return encode_base58_checksum(prefix + bytes(self) + suffix)
 
     def tweak_add(self, tweak32: bytes) -> "PrivateKey":
-        tweaked = ec_seckey_tweak_add(self.k, tweak32)
+        tweaked = ec.backend.seckey_tweak_add(self.k, tweak32)
         return PrivateKey(sec_exp=tweaked)
 
     @classmethod
@@ -153,16 +155,19 @@ class PrivateKey(object):
 class PublicKey(object):
 
     __slots__ = (
-        "K"
+        "K",
+        "backend",
     )
 
-    def __init__(self, pub_key):
+    def __init__(self, pub_key, backend: ec.ECBackend = None):
         """
         Initializes PublicKey object.
 
-        :param key: secp256k1 pubkey or ecdsa.VerifyingKey
+        :param pub_key: public key object of EC backend
+        :param backend: EC backend that made pub_key (default=active one)
         """
         self.K = pub_key
+        self.backend = backend or ec.backend
 
     def __eq__(self, other: "PublicKey") -> bool:
         """
@@ -172,6 +177,10 @@ class PublicKey(object):
         """
         return self.sec() == other.sec()
 
+    def __reduce__(self):
+        # pickled as SEC bytes, backend key objects may be C structs
+        return (PublicKey.parse, (self.sec(), self.backend))
+
     @property
     def point(self): # -> ecdsa.ellipticcurve.Point:
         """
@@ -179,7 +188,8 @@ class PublicKey(object):
 
         :return: point on curve
         """
-        return self.K.pubkey.point
+        import ecdsa
+        return ecdsa.VerifyingKey.from_string(self.sec(), curve=ecdsa.SECP256k1).pubkey.point
 
     def sec(self, compressed: bool = True) -> bytes:
         """
@@ -188,26 +198,22 @@ class PublicKey(object):
         :param compressed: whether to use compressed format (default=True)
         :return: SEC encoded public key
         """
-        try:
-            return ec_pubkey_serialize(self.K, compressed=compressed)
-        except NameError:
-            return self.K.to_string(encoding="compressed" if compressed else "uncompressed")
+        return self.backend.pubkey_serialize(self.K, compressed=compressed)
 
     def tweak_add(self, tweak32: bytes) -> "PublicKey":
-        return PublicKey(pub_key=ec_pubkey_tweak_add(self.K, tweak32))
+        return PublicKey(self.backend.pubkey_tweak_add(self.K, tweak32), self.backend)
 
     @classmethod
-    def parse(cls, key_bytes: bytes) -> "PublicKey":
+    def parse(cls, key_bytes: bytes, backend: ec.ECBackend = None) -> "PublicKey":
         """
         Initializes public key from byte sequence.
 
         :param key_bytes: byte representation of public key
+        :param backend: EC backend to use (default=active one)
         :return: public key
         """
-        try:
-            return cls(pub_key=ec_pubkey_parse(key_bytes))
-        except NameError:
-            return cls(ecdsa.VerifyingKey.from_string(key_bytes, curve=SECP256k1))
+        backend = backend or ec.backend
+        return cls(backend.pubkey_parse(key_bytes), backend)
 
     @classmethod
     def from_point(cls, point) -> "PublicKey":
@@ -217,7 +223,9 @@ class PublicKey(object):
         :param point: point on elliptic curve
         :return: public key
         """
-        return cls(ecdsa.VerifyingKey.from_public_point(point, curve=SECP256k1))
+        import ecdsa
+        vk = ecdsa.VerifyingKey.from_public_point(point, curve=ecdsa.SECP256k1)
+        return cls.parse(vk.to_string(encoding="compressed"))
 
     def h160(self, compressed: bool = True) -> bytes:
         """
@@ -247,7 +255,7 @@ class PublicKey(object):
             return encode_base58_checksum(prefix + h160)
         elif addr_fmt == "p2wpkh":
             hrp = "tb" if testnet else "bc"
-            return bech32_encode(hrp=hrp, witver=0, witprog=h160)
+            return bech32_encode(hrp=hrp, witver=0, witprog=h160, trusted=True)
         elif addr_fmt == "p2sh-p2wpkh":
             scr = b"\x00\x14" + h160  # witversion 0 + pubkey hash
             h160 = hash160(scr)
@@ -272,7 +280,9 @@ class PubKeyNode(object):
         "parsed_parent_fingerprint",
         "parsed_version",
         "testnet",
-        "children"
+        "children",
+        "_public_key",
+        "_fingerprint",
     )
 
     def __init__(self, key: bytes, chain_code: bytes, index: int = 0,
@@ -298,6 +308,24 @@ class PubKeyNode(object):
         self.parsed_parent_fingerprint = parent_fingerprint
         self.parsed_version = None
         self.testnet = testnet
+        self._public_key = None
+        self._fingerprint = None
+
+    def __getstate__(self) -> dict:
+        """
+        Pickle support, parsed key objects are left out as they can be
+        C structures of EC backend.
+        """
+        return {k: getattr(self, k, None) for k in self._all_slots()
+                if not k.startswith("_")}
+
+    def __setstate__(self, state: dict) -> None:
+        for k in self._all_slots():
+            setattr(self, k, state.get(k))
+
+    @classmethod
+    def _all_slots(cls) -> list:
+        return [k for c in cls.__mro__ for k in getattr(c, "__slots__", ())]
 
     def __eq__(self, other) -> bool:
         """
@@ -323,7 +351,9 @@ class PubKeyNode(object):
 
         :return: public key of public key node
         """
-        return PublicKey.parse(key_bytes=self.key)
+        if self._public_key is None:
+            self._public_key = PublicKey.parse(key_bytes=self.key)
+        return self._public_key
 
     @property
     def parent_fingerprint(self) -> bytes:
@@ -332,7 +362,7 @@ class PubKeyNode(object):
 
         If node is parsed from extended key, only parsed parent fingerprint
         is available. If node is derived, parent fingerprint is calculated
-        from parent node.
+        from parent node (once, parent keeps it for all its children).
 
         :return: parent fingerprint
         """
@@ -383,7 +413,9 @@ class PubKeyNode(object):
 
         :return: first four bytes of SHA256(RIPEMD160(public key))
         """
-        return hash160(self.public_key.sec())[:4]
+        if self._fingerprint is None:
+            self._fingerprint = hash160(self.public_key.sec())[:4]
+        return self._fingerprint
 
     @classmethod
     def parse(cls, s: Union[str, bytes, BytesIO],
@@ -508,20 +540,11 @@ class PubKeyNode(object):
             msg=self.key + int_to_big_endian(index, 4)
         )
         IL, IR = I[:32], I[32:]
-        # TODO this does not check whether IL is not zero (secp256k1 also does not check)
         try:
             Ki = self.public_key.tweak_add(IL)
-        except NameError:
-            if big_endian_to_int(IL) >= CURVE_ORDER:
-                InvalidKeyError(
-                    "public key {} is greater/equal to curve order".format(
-                        big_endian_to_int(IL)
-                    )
-                )
-            point = PrivateKey.parse(IL).K.point + self.public_key.point
-            if point == INFINITY:
-                raise InvalidKeyError("public key is a point at infinity")
-            Ki = PublicKey.from_point(point=point)
+        except ValueError as exc:
+            # IL >= n or point at infinity
+            raise InvalidKeyError(str(exc))
 
         child = self.__class__(
             key=Ki.sec(),
@@ -531,8 +554,47 @@ class PubKeyNode(object):
             testnet=self.testnet,
             parent=self
         )
+        # already have it, no need to parse key again
+        child._public_key = Ki
         return child
 
+    def derive_children(self, start: int, count: int) -> list:
+        """
+        Non-hardened children start .. start+count-1, same as calling ckd()
+        for each index but faster: HMAC key is set up once and EC backend
+        gets all tweaks in one call.
+
+        :param start: first derivation index
+        :param count: number of children
+        :return: list of derived children
+        """
+        if start + count > HARDENED:
+            raise RuntimeError("failure: hardened child for public ckd")
+        indexes = range(start, start + count)
+        digests = hmac_sha512_many(self.chain_code, self.key,
+                                   (int_to_big_endian(i, 4) for i in indexes))
+        pub = self.public_key
+        try:
+            keys = pub.backend.pubkey_tweak_add_batch(pub.K, [I[:32] for I in digests])
+        except ValueError:
+            # some IL >= n or point at infinity; ckd() tells which
+            return [self.ckd(i) for i in indexes]
+
+        children = []
+        for i, I, K in zip(indexes, digests, keys):
+            Ki = PublicKey(K, pub.backend)
+            child = self.__class__(
+                key=Ki.sec(),
+                chain_code=I[32:],
+                index=i,
+                depth=self.depth + 1,
+                testnet=self.testnet,
+                parent=self
+            )
+            child._public_key = Ki
+            children.append(child)
+        return children
+
 
 class PrvKeyNode(PubKeyNode):
 
@@ -540,6 +602,14 @@ class PrvKeyNode(PubKeyNode):
     testnet_version: int = 0x04358394
     mainnet_version: int = 0x0488ADE4
 
+    __slots__ = (
+        "_private_key",
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._private_key = None
+
     @property
     def private_key(self) -> PrivateKey:
         """
@@ -547,9 +617,12 @@ class PrvKeyNode(PubKeyNode):
 
         :return: public key of private key node
         """
-        if len(self.key) == 33 and self.key[0] == 0:
-            return PrivateKey(self.key[1:])
-        return PrivateKey(self.key)
+        if self._private_key is None:
+            if len(self.key) == 33 and self.key[0] == 0:
+                self._private_key = PrivateKey(self.key[1:])
+            else:
+                self._private_key = PrivateKey(self.key)
+        return self._private_key
 
     @property
     def public_key(self) -> PublicKey:
@@ -594,15 +667,12 @@ class PrvKeyNode(PubKeyNode):
         int_left_key = big_endian_to_int(IL)
         if int_left_key == 0:
             raise InvalidKeyError("master key is zero")
-        try:
-            ec_seckey_verify(IL)
-        except NameError:
-            if int_left_key >= CURVE_ORDER:
-                raise InvalidKeyError(
-                    "master key {} is greater/equal to curve order".format(
-                        int_left_key
-                    )
+        if int_left_key >= ec.CURVE_ORDER:
+            raise InvalidKeyError(
+                "master key {} is greater/equal to curve order".format(
+                    int_left_key
                 )
+            )
         # chain code
         IR = I[32:]
         return cls(
@@ -662,21 +732,10 @@ class PrvKeyNode(PubKeyNode):
         I = hmac_sha512(key=self.chain_code, msg=data)
         IL, IR = I[:32], I[32:]
         try:
-            ki = self.private_key.tweak_add(IL)
-            # if ki == PrivateKey.from_int(0):
-            #    InvalidKeyError("private key is zero")
-        except NameError:
-            if big_endian_to_int(IL) >= CURVE_ORDER:
-                InvalidKeyError(
-                    "private key {} is greater/equal to curve order".format(
-                        big_endian_to_int(IL)
-                    )
-                )
-            ki = (int.from_bytes(IL, "big") +
-                  big_endian_to_int(bytes(self.private_key))) % CURVE_ORDER
-            if ki == 0:
-                InvalidKeyError("private key is zero")
-            ki = int_to_big_endian(ki, 32)
+            ki = ec.backend.seckey_tweak_add(bytes(self.private_key), IL)
+        except ValueError as exc:
+            # IL >= n or resulting key is zero
+            raise InvalidKeyError(str(exc))
 
         child = self.__class__(
             key=bytes(ki),
@@ -688,6 +747,138 @@ class PrvKeyNode(PubKeyNode):
         )
         return child
 
+    def derive_children(self, start: int, count: int) -> list:
+        """
+        Children start .. start+count-1, same as calling ckd() for each
+        index but HMAC key and message prefix are set up once.
+
+        :param start: first derivation index
+        :param count: number of children
+        :return: list of derived children
+        """
+        indexes = range(start, start + count)
+        k = bytes(self.private_key)
+        if start >= HARDENED:
+            prefix = b"\x00" + k
+        elif start + count <= HARDENED:
+            prefix = self.public_key.sec()
+        else:
+            # range crosses into hardened indexes
+            return [self.ckd(i) for i in indexes]
+
+        digests = hmac_sha512_many(self.chain_code, prefix,
+                                   (int_to_big_endian(i, 4) for i in indexes))
+        children = []
+        for i, I in zip(indexes, digests):
+            try:
+                ki = ec.backend.seckey_tweak_add(k, I[:32])
+            except ValueError as exc:
+                raise InvalidKeyError(str(exc))
+            children.append(self.__class__(
+                key=ki,
+                chain_code=I[32:],
+                index=i,
+                depth=self.depth + 1,
+                testnet=self.testnet,
+                parent=self
+            ))
+        return children
+
+
+class DerivationCache(object):
+    """
+    Bounded LRU cache of derived child nodes, keyed by (parent node, index).
+
+    Paths like 0/i and 1/i share their first step, with the cache the shared
+    branch node is derived once and not again for each i.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        """
+        Initializes empty cache.
+
+        :param maxsize: max number of nodes kept, 0 disables caching
+        """
+        self.maxsize = maxsize
+        self.nodes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def node_id(node: Prv_or_PubKeyNode, index: int) -> tuple:
+        """
+        Everything derived child depends on.
+
+        :param node: parent node
+        :param index: derivation index
+        :return: cache key
+        """
+        return (type(node), node.key, node.chain_code, node.depth, node.testnet, index)
+
+    def ckd(self, node: Prv_or_PubKeyNode, index: int) -> Prv_or_PubKeyNode:
+        """
+        Derives child of node, or returns previously derived one.
+
+        :param node: parent node
+        :param index: derivation index
+        :return: derived child
+        """
+        if not self.maxsize:
+            return node.ckd(index)
+
+        k = self.node_id(node, index)
+        child = self.nodes.get(k)
+        if child is not None:
+            self.hits += 1
+            self.nodes.move_to_end(k)
+            return child
+
+        self.misses += 1
+        child = node.ckd(index)
+        self.nodes[k] = child
+        if len(self.nodes) > self.maxsize:
+            self.nodes.popitem(last=False)
+        return child
+
+    def ckd_range(self, node: Prv_or_PubKeyNode, start: int, count: int) -> list:
+        """
+        Children start .. start+count-1 of node; all missing ones
+        are derived in one derive_children() call.
+
+        :param node: parent node
+        :param start: first derivation index
+        :param count: number of children
+        :return: list of derived children
+        """
+        if not self.maxsize:
+            return node.derive_children(start, count)
+
+        keys = [self.node_id(node, i) for i in range(start, start + count)]
+        rv = [self.nodes.get(k) for k in keys]
+        missing = [n for n, child in enumerate(rv) if child is None]
+        self.hits += count - len(missing)
+        self.misses += len(missing)
+        if missing:
+            # one contiguous range covering all missing ones
+            lo, hi = missing[0], missing[-1] + 1
+            rv[lo:hi] = node.derive_children(start + lo, hi - lo)
+
+        for k, child in zip(keys, rv):
+            self.nodes[k] = child
+            self.nodes.move_to_end(k)
+        while len(self.nodes) > self.maxsize:
+            self.nodes.popitem(last=False)
+        return rv
+
+    def clear(self) -> None:
+        """Drops all cached nodes and resets statistics."""
+        self.nodes.clear()
+        self.hits = self.misses = 0
+
+
+# shared by all BIP32Node.subkey_for_path() calls
+derivation_cache = DerivationCache()
+
 
 class BIP32Node:
     def __init__(self, node, netcode="XTN"):
@@ -713,9 +904,14 @@ class BIP32Node:
         path_list = list(str2ipath(path))
         node = self.node
         for idx in path_list:
-            node = node.ckd(idx)
+            node = derivation_cache.ckd(node, idx)
         return BIP32Node(node)
 
+    def derive_children(self, start, count):
+        # [subkey_for_path(str(i)) for i in range(start, start+count)], derived in one batch
+        return [BIP32Node(node) for node in
+                derivation_cache.ckd_range(self.node, start, count)]
+
     def hwif(self, as_private=False):
         is_pub = type(self.node) is PubKeyNode
         if is_pub and as_private:
@@ -753,3 +949,73 @@ class BIP32Node:
 
     def parent_fingerprint(self):
         return self.node.parent_fingerprint
+
+
+class TestBIP32(unittest.TestCase):
+    """
+    Run with: python3 -m unittest psbt_faker.bip32
+
+    Everything is checked on each EC backend installed here.
+    """
+    # BIP-32 test vector 1
+    # See https://github.com/bitcoin/bips/blob/master/bip-0032.mediawiki#test-vector-1
+    SEED = "000102030405060708090a0b0c0d0e0f"
+    VECTOR = [
+        ("", "xpub661MyMwAqRbcFtXgS5sYJABqqG9YLmC4Q1Rdap9gSE8NqtwybGhePY2gZ29ESFjqJoCu1Rupje8YtGqsefD265TMg7usUDFdp6W1EGMcet8",
+            "xprv9s21ZrQH143K3QTDL4LXw2F7HEK3wJUD2nW2nRk4stbPy6cq3jPPqjiChkVvvNKmPGJxWUtg6LnF5kejMRNNU3TGtRBeJgk33yuGBxrMPHi"),
+        ("0h", "xpub68Gmy5EdvgibQVfPdqkBBCHxA5htiqg55crXYuXoQRKfDBFA1WEjWgP6LHhwBZeNK1VTsfTFUHCdrfp1bgwQ9xv5ski8PX9rL2dZXvgGDnw", None),
+        ("0h/1", "xpub6ASuArnXKPbfEwhqN6e3mwBcDTgzisQN1wXN9BJcM47sSikHjJf3UFHKkNAWbWMiGj7Wf5uMash7SyYq527Hqck2AxYysAA7xmALppuCkwQ", None),
+        ("0h/1/2h", "xpub6D4BDPcP2GT577Vvch3R8wDkScZWzQzMMUm3PWbmWvVJrZwQY4VUNgqFJPMM3No2dFDFGTsxxpG5uJh7n7epu4trkrX7x7DogT5Uv6fcLW5", None),
+        ("0h/1/2h/2", "xpub6FHa3pjLCk84BayeJxFW2SP4XRrFd1JYnxeLeU8EqN3vDfZmbqBqaGJAyiLjTAwm6ZLRQUMv1ZACTj37sR62cfN7fe5JnJ7dh8zL4fiyLHV", None),
+        ("0h/1/2h/2/1000000000", "xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy", None),
+    ]
+
+    def backends(self):
+        prev = ec.backend
+        try:
+            for name in ec.available_backends():
+                ec.backend = ec.get_backend(name)
+                # or subkey_for_path() returns nodes made by previous backend
+                derivation_cache.clear()
+                with self.subTest(backend=name):
+                    yield name
+        finally:
+            ec.backend = prev
+            derivation_cache.clear()
+
+    def test_vector_1(self):
+        """BIP-32 test vector 1, private and public derivation."""
+        for _ in self.backends():
+            m = BIP32Node.from_master_secret(bytes.fromhex(self.SEED), netcode="BTC")
+            for path, xpub, xprv in self.VECTOR:
+                node = m.subkey_for_path(path) if path else m
+                self.assertEqual(node.hwif(), xpub, path)
+                if xprv:
+                    self.assertEqual(node.hwif(as_private=True), xprv)
+                # last non-hardened step again, from the parent's xpub
+                if path and not path.endswith("h"):
+                    parent, idx = path.rsplit("/", 1)
+                    pub = BIP32Node.from_hwif(m.subkey_for_path(parent).hwif())
+                    self.assertEqual(pub.subkey_for_path(idx).hwif(), xpub)
+
+    def test_derive_children(self):
+        """derive_children() gives the same nodes as ckd() one index at a time."""
+        for _ in self.backends():
+            prv = PrvKeyNode.master_key(bytes.fromhex(self.SEED))
+            pub = PubKeyNode.parse(prv.extended_public_key())
+            for node, ranges in [
+                (pub, [(0, 1), (0, 20), (1000, 7), (HARDENED - 3, 3)]),
+                (prv, [(0, 20), (HARDENED, 5), (HARDENED - 2, 4)]),
+            ]:
+                for start, count in ranges:
+                    got = node.derive_children(start, count)
+                    want = [node.ckd(i) for i in range(start, start + count)]
+                    self.assertEqual(len(got), count)
+                    for g, w in zip(got, want):
+                        self.assertEqual(g.index, w.index)
+                        self.assertEqual(g.chain_code, w.chain_code)
+                        self.assertEqual(g.public_key.sec(), w.public_key.sec())
+                        self.assertEqual(g.extended_public_key(), w.extended_public_key())
+
+            with self.assertRaises(RuntimeError):
+                pub.derive_children(HARDENED - 1, 2)
@@ -0,0 +1,238 @@
+#
+# On-disk cache of generated PSBTs, content-addressed by the generation request.
+#
+# Only seeded requests are cached: same arguments and seed always make the same PSBT,
+# so a hit can be returned without doing any key derivation or hashing.
+#
+import os, json, time, hashlib, tempfile, unittest
+from .bip32 import BIP32Node
+from .wallet import WalletContext
+from .txn import OutputsSummary
+
+# 512 MiB
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# modules whose code decides the bytes of a PSBT; any edit to them is a new cache
+_GENERATOR_MODULES = ('txn.py', 'psbt.py', 'ctransaction.py', 'serialize.py',
+                      'bip32.py', 'ec.py', 'wallet.py', 'segwit_addr.py', 'base58.py',
+                      'helpers.py', 'ripemd.py', 'multisig.py')
+
+def _code_version():
+    h = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for fn in _GENERATOR_MODULES:
+        with open(os.path.join(here, fn), 'rb') as fd:
+            h.update(fd.read())
+    return h.hexdigest()
+
+CODE_VERSION = _code_version()
+
+# arguments that make no difference to the PSBT, only to how fast it is made
+_SPEED_ONLY = ('addr_index',)
+
+def _canon(obj):
+    # arguments to something json can encode, the same way every time
+    if isinstance(obj, BIP32Node):
+        return obj.hwif()
+    if isinstance(obj, WalletContext):
+        return [obj.account_key.hwif(), obj.xfp.hex(), obj.orig_der]
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.hex()
+    if isinstance(obj, (list, tuple)):
+        return [_canon(i) for i in obj]
+    if isinstance(obj, dict):
+        return {str(k): _canon(v) for k, v in obj.items()}
+    return obj
+
+
+class PSBTCache:
+    "Directory of PSBTs: KEY.psbt (binary) and KEY.json (digest, length, output scripts)"
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.size = None            # total bytes on disk, found at first put()
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, func, args, kws):
+        # hash of the generation request; kws must include an int seed
+        assert isinstance(kws.get('seed'), int), 'only seeded requests can be cached'
+        kws = {k: v for k, v in kws.items() if k not in _SPEED_ONLY}
+        req = [CODE_VERSION, func.__name__, _canon(args), _canon(kws)]
+        return hashlib.sha256(json.dumps(req, sort_keys=True, default=repr).encode()).hexdigest()
+
+    def _fnames(self, key):
+        base = os.path.join(self.path, key)
+        return base + '.psbt', base + '.json'
+
+    def get(self, key):
+        # (psbt, outs) if cached and intact, else None
+        psbt_fn, meta_fn = self._fnames(key)
+        try:
+            with open(meta_fn, 'rt') as fd:
+                meta = json.load(fd)
+            with open(psbt_fn, 'rb') as fd:
+                psbt = fd.read()
+        except (OSError, ValueError):
+            return None
+        if 'scripts' not in meta:
+            # made by older version
+            return None
+
+        if len(psbt) != meta.get('length') \
+                or hashlib.sha256(psbt).hexdigest() != meta.get('sha256'):
+            # damaged or half written by someone else; forget it
+            self.remove(key)
+            return None
+
+        # recently used: keeps it from eviction
+        try:
+            os.utime(meta_fn)
+        except OSError:
+            pass
+
+        # addresses are rendered only if caller looks at them, same as when generated
+        scripts = [(amt, bytes.fromhex(spk), chg) for amt, spk, chg in meta['scripts']]
+        return psbt, OutputsSummary(scripts, meta['testnet'])
+
+    def put(self, key, psbt, outs):
+        # outs: the OutputsSummary from fake_txn() / fake_ms_txn()
+        psbt = bytes(psbt)
+        meta = json.dumps(dict(sha256=hashlib.sha256(psbt).hexdigest(), length=len(psbt),
+                               scripts=[[amt, bytes(spk).hex(), chg]
+                                        for amt, spk, chg in outs.scripts],
+                               testnet=outs.testnet)).encode()
+
+        # PSBT first, then meta: an entry without meta file does not exist
+        added = 0
+        for fn, data in zip(self._fnames(key), (psbt, meta)):
+            tmp = '%s.%d.tmp' % (fn, os.getpid())
+            with open(tmp, 'wb') as fd:
+                fd.write(data)
+            os.replace(tmp, fn)
+            added += len(data)
+
+        if self.size is None:
+            self.size = self.disk_usage()
+        else:
+            self.size += added
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def remove(self, key):
+        for fn in self._fnames(key):
+            try:
+                os.unlink(fn)
+            except FileNotFoundError:
+                pass
+
+    def _entries(self):
+        # [(last used, bytes, key), ...] for all complete entries
+        rv = []
+        for de in os.scandir(self.path):
+            if not de.name.endswith('.json'):
+                continue
+            key = de.name[:-5]
+            try:
+                st = de.stat()
+                size = st.st_size + os.stat(self._fnames(key)[0]).st_size
+            except FileNotFoundError:
+                continue
+            rv.append((st.st_mtime, size, key))
+        return rv
+
+    def disk_usage(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, target=None):
+        # drop least recently used entries until under target (default: 90% of max_size,
+        # so a full cache is not rescanned on every put)
+        if target is None:
+            target = self.max_size * 9 // 10
+
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= target:
+                break
+            self.remove(key)
+            total -= size
+
+        self.size = total
+
+
+class TestPSBTCache(unittest.TestCase):
+    # python3 -m unittest psbt_faker.cache
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = PSBTCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make(self, seed=1):
+        # (psbt, outs) from a seeded fake_txn() going through the cache
+        from . import SIM_XPUB
+        from .batch import _make_one
+        from .txn import fake_txn
+        kws = dict(master_xpub=SIM_XPUB, change_outputs=[0], outstyles=['p2pkh', 'p2tr'],
+                   seed=seed)
+        return _make_one(fake_txn, (2, 3), kws, cache=self.cache), \
+               self.cache.key(fake_txn, (2, 3), kws)
+
+    def test_hit(self):
+        (psbt, outs), key = self.make()
+        hit_psbt, hit_outs = self.cache.get(key)
+        self.assertEqual(hit_psbt, bytes(psbt))
+        self.assertIsInstance(hit_outs, OutputsSummary)
+        self.assertEqual(hit_outs.testnet, outs.testnet)
+        self.assertEqual(list(hit_outs), list(outs))
+
+    def test_damaged(self):
+        (psbt, outs), key = self.make()
+        psbt_fn, meta_fn = self.cache._fnames(key)
+
+        # same length, one bit off: digest catches it
+        with open(psbt_fn, 'r+b') as fd:
+            fd.seek(40)
+            b = fd.read(1)
+            fd.seek(40)
+            fd.write(bytes([b[0] ^ 1]))
+        self.assertIsNone(self.cache.get(key))
+        self.assertFalse(os.path.exists(psbt_fn) or os.path.exists(meta_fn))
+
+        # miss, so made again: same bytes, cached again
+        self.assertEqual(self.make(), ((psbt, outs), key))
+        self.assertEqual(self.cache.get(key)[0], bytes(psbt))
+
+        # PSBT without meta file, or meta file without PSBT: not there
+        os.unlink(meta_fn)
+        self.assertIsNone(self.cache.get(key))
+        self.make()
+        os.unlink(psbt_fn)
+        self.assertIsNone(self.cache.get(key))
+
+    def test_evict(self):
+        keys = [self.make(seed)[1] for seed in range(3)]
+        size = self.cache.disk_usage() // 3
+
+        # seed 0 oldest; then used again, making seed 1 least recently used
+        now = time.time()
+        for n, key in enumerate(keys):
+            t = now - 100 + n
+            os.utime(self.cache._fnames(key)[1], (t, t))
+        self.assertIsNotNone(self.cache.get(keys[0]))
+
+        # room for three and a half: fourth one pushes out seed 1 only
+        self.cache.max_size = size * 7 // 2
+        keys.append(self.make(3)[1])
+
+        self.assertIsNone(self.cache.get(keys[1]))
+        for key in (keys[0], keys[2], keys[3]):
+            self.assertIsNotNone(self.cache.get(key))
+        self.assertLessEqual(self.cache.disk_usage(), self.cache.max_size)
+        self.assertEqual(self.cache.size, self.cache.disk_usage())
+
+# EOF
@@ -17,9 +17,12 @@ CTransaction,CTxIn, CTxOut, etc....:
 import copy, struct, hashlib
 
 from .serialize import (
+    deser_compact_size_from,
     deser_uint256,
     deser_string,
+    deser_string_from,
     deser_string_vector,
+    deser_string_vector_from,
     deser_vector,
     ser_uint256,
     ser_string,
@@ -50,6 +53,11 @@ class COutPoint(object):
         self.hash = deser_uint256(f)
         self.n = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_from(self, buf, pos: int) -> int:
+        self.hash = int.from_bytes(buf[pos:pos+32], "little")
+        self.n = int.from_bytes(buf[pos+32:pos+36], "little")
+        return pos + 36
+
     def serialize(self) -> bytes:
         r = b""
         r += ser_uint256(self.hash)
@@ -80,6 +88,14 @@ class CTxIn(object):
         self.scriptSig = deser_string(f)
         self.nSequence = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_from(self, buf, pos: int) -> int:
+        self.prevout = COutPoint()
+        pos = self.prevout.deserialize_from(buf, pos)
+        scriptSig, pos = deser_string_from(buf, pos)
+        self.scriptSig = bytes(scriptSig)
+        self.nSequence = int.from_bytes(buf[pos:pos+4], "little")
+        return pos + 4
+
     def serialize(self) -> bytes:
         r = b""
         r += self.prevout.serialize()
@@ -102,6 +118,12 @@ class CTxOut(object):
         self.nValue = struct.unpack("<q", f.read(8))[0]
         self.scriptPubKey = deser_string(f)
 
+    def deserialize_from(self, buf, pos: int) -> int:
+        self.nValue = int.from_bytes(buf[pos:pos+8], "little", signed=True)
+        scriptPubKey, pos = deser_string_from(buf, pos+8)
+        self.scriptPubKey = bytes(scriptPubKey)
+        return pos
+
     def serialize(self) -> bytes:
         r = b""
         r += struct.pack("<q", self.nValue)
@@ -135,6 +157,11 @@ class CTxInWitness(object):
     def deserialize(self, f) -> None:
         self.scriptWitness.stack = deser_string_vector(f)
 
+    def deserialize_from(self, buf, pos: int) -> int:
+        stack, pos = deser_string_vector_from(buf, pos)
+        self.scriptWitness.stack = [bytes(i) for i in stack]
+        return pos
+
     def serialize(self) -> bytes:
         return ser_string_vector(self.scriptWitness.stack)
 
@@ -212,6 +239,37 @@ class CTransaction(object):
         self.sha256 = None
         self.hash = None
 
+    def deserialize_from(self, buf, pos: int = 0) -> int:
+        # same as deserialize() but from offset of a buffer, returns offset after txn
+        def vector(pos, cls):
+            nit, pos = deser_compact_size_from(buf, pos)
+            r = []
+            for _ in range(nit):
+                t = cls()
+                pos = t.deserialize_from(buf, pos)
+                r.append(t)
+            return r, pos
+
+        self.nVersion = int.from_bytes(buf[pos:pos+4], "little", signed=True)
+        self.vin, pos = vector(pos + 4, CTxIn)
+        flags = 0
+        if len(self.vin) == 0:
+            flags = buf[pos]
+            pos += 1
+            if (flags != 0):
+                self.vin, pos = vector(pos, CTxIn)
+                self.vout, pos = vector(pos, CTxOut)
+        else:
+            self.vout, pos = vector(pos, CTxOut)
+        if flags != 0:
+            self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
+            for w in self.wit.vtxinwit:
+                pos = w.deserialize_from(buf, pos)
+        self.nLockTime = int.from_bytes(buf[pos:pos+4], "little")
+        self.sha256 = None
+        self.hash = None
+        return pos + 4
+
     def serialize_without_witness(self) -> bytes:
         r = b""
         r += struct.pack("<i", self.nVersion)
@@ -254,14 +312,19 @@ class CTransaction(object):
 
     # We will only cache the serialization without witness in
     # self.sha256 and self.hash -- those are expected to be the txid.
-    def calc_sha256(self, with_witness: bool = False) -> Optional[int]:
+    # - raw: serialization without witness, when caller already has it (for a
+    #   txn with no witness, that's also what serialize_with_witness() gives)
+    def calc_sha256(self, with_witness: bool = False, raw: bytes = None) -> Optional[int]:
         if with_witness:
             # Don't cache the result, just return it
             return uint256_from_str(hash256(self.serialize_with_witness()))
 
+        # one serialization and one hash256 provide both sha256 and hash;
+        # nothing kept, so in-place edits of vin/vout are always seen
+        h = hash256(self.serialize() if raw is None else raw)
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = hash256(self.serialize())
+            self.sha256 = uint256_from_str(h)
+        self.hash = h
         return None
 
     def is_null(self) -> bool:
@@ -0,0 +1,499 @@
+#
+# Elliptic curve (secp256k1) backends for BIP-32 derivation.
+#
+# Only the few operations bip32.py needs: generator multiply (pubkey_create),
+# parse/serialize of SEC public keys and tweak_add on public and private keys.
+# Public keys are opaque objects of the backend that made them.
+#
+# Backend is picked at import: PSBT_FAKER_EC_BACKEND env var if set, else the
+# fastest one installed. set_backend() changes it later.
+#
+import os, sys, time, struct, hashlib, random, unittest
+from collections import OrderedDict
+
+ENV_VAR = 'PSBT_FAKER_EC_BACKEND'
+
+# curve order
+CURVE_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+
+
+class ECBackend:
+    """Interface of a secp256k1 backend; invalid keys or tweaks raise ValueError."""
+
+    name = None
+    # C library or pure Python
+    native = True
+
+    def __reduce__(self):
+        # same backend in other process, by name
+        return (get_backend, (self.name,))
+
+    def seckey_verify(self, seckey: bytes) -> None:
+        raise NotImplementedError
+
+    def pubkey_create(self, seckey: bytes):
+        """Generator multiply: public key of 32-byte secret."""
+        raise NotImplementedError
+
+    def pubkey_parse(self, sec: bytes):
+        raise NotImplementedError
+
+    def pubkey_serialize(self, pubkey, compressed: bool = True) -> bytes:
+        raise NotImplementedError
+
+    def pubkey_tweak_add(self, pubkey, tweak32: bytes):
+        """pubkey + tweak*G"""
+        raise NotImplementedError
+
+    def seckey_tweak_add(self, seckey: bytes, tweak32: bytes) -> bytes:
+        """(seckey + tweak) mod n"""
+        raise NotImplementedError
+
+    def pubkey_tweak_add_batch(self, pubkey, tweaks: list) -> list:
+        """[pubkey + tweak*G for each tweak], i.e. siblings in BIP-32"""
+        return [self.pubkey_tweak_add(pubkey, t) for t in tweaks]
+
+
+class Secp256k1Backend(ECBackend):
+    """libsecp256k1 via pysecp256k1"""
+
+    name = 'pysecp256k1'
+
+    def __init__(self):
+        import pysecp256k1 as lib
+        self.lib = lib
+
+    def seckey_verify(self, seckey):
+        try:
+            self.lib.ec_seckey_verify(seckey)
+        except Exception as exc:
+            raise ValueError(str(exc))
+
+    def pubkey_create(self, seckey):
+        return self.lib.ec_pubkey_create(seckey)
+
+    def pubkey_parse(self, sec):
+        return self.lib.ec_pubkey_parse(sec)
+
+    def pubkey_serialize(self, pubkey, compressed=True):
+        return self.lib.ec_pubkey_serialize(pubkey, compressed=compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweak32):
+        try:
+            return self.lib.ec_pubkey_tweak_add(pubkey, tweak32)
+        except Exception as exc:
+            raise ValueError(str(exc))
+
+    def seckey_tweak_add(self, seckey, tweak32):
+        try:
+            return self.lib.ec_seckey_tweak_add(seckey, tweak32)
+        except Exception as exc:
+            raise ValueError(str(exc))
+
+
+class CoincurveBackend(ECBackend):
+    """libsecp256k1 via coincurve"""
+
+    name = 'coincurve'
+
+    def __init__(self):
+        import coincurve
+        self.PublicKey = coincurve.PublicKey
+        self.PrivateKey = coincurve.PrivateKey
+
+    def seckey_verify(self, seckey):
+        self.PrivateKey(seckey)
+
+    def pubkey_create(self, seckey):
+        return self.PublicKey.from_secret(seckey)
+
+    def pubkey_parse(self, sec):
+        return self.PublicKey(sec)
+
+    def pubkey_serialize(self, pubkey, compressed=True):
+        return pubkey.format(compressed=compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweak32):
+        return pubkey.add(tweak32)
+
+    def seckey_tweak_add(self, seckey, tweak32):
+        return self.PrivateKey(seckey).add(tweak32).secret
+
+
+# secp256k1: y^2 = x^3 + 7 over GF(P), generator G
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+# Jacobian coordinates: (X, Y, Z) is affine (X/Z^2, Y/Z^3), Z == 0 is infinity.
+# Adds and doubles need no modular inversion, only the final conversion to
+# affine does; batch_inverse() makes that one inversion for a whole batch.
+
+def jacobian_double(pt):
+    X, Y, Z = pt
+    if not Y:
+        return (0, 1, 0)
+    YY = Y * Y % P
+    S = 4 * X * YY % P
+    M = 3 * X * X % P
+    X3 = (M * M - 2 * S) % P
+    Y3 = (M * (S - X3) - 8 * YY * YY) % P
+    return (X3, Y3, 2 * Y * Z % P)
+
+def jacobian_add_affine(pt, aff):
+    # pt + aff, where aff is an affine (x, y)
+    X1, Y1, Z1 = pt
+    if not Z1:
+        return (aff[0], aff[1], 1)
+    ZZ = Z1 * Z1 % P
+    H = (aff[0] * ZZ - X1) % P
+    R = (aff[1] * ZZ * Z1 - Y1) % P
+    if not H:
+        return jacobian_double(pt) if not R else (0, 1, 0)
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    return (X3, Y3, Z1 * H % P)
+
+def batch_inverse(values):
+    # modular inverses of all values with one pow(): Montgomery's trick
+    acc = 1
+    prefix = []
+    for v in values:
+        prefix.append(acc)
+        acc = acc * v % P
+    inv = pow(acc, P - 2, P)
+    rv = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        rv[i] = prefix[i] * inv % P
+        inv = inv * values[i] % P
+    return rv
+
+def to_affine_batch(points):
+    # [(x, y), ...] of Jacobian points, none of them infinity
+    rv = []
+    for (X, Y, Z), zi in zip(points, batch_inverse([pt[2] for pt in points])):
+        zi2 = zi * zi % P
+        rv.append((X * zi2 % P, Y * zi2 * zi % P))
+    return rv
+
+# fixed-base table: G_TABLE[i][d-1] is affine d * 2^(WINDOW*i) * G, for d in 1..2^WINDOW-1
+# - takes a moment to build, so it can be kept in a file: see load_g_table()
+WINDOW = 8
+G_TABLE = None
+
+# file named here keeps the table between processes; made if missing
+G_TABLE_ENV_VAR = 'PSBT_FAKER_G_TABLE'
+
+# magic, window bits, sha256 of the points that follow (x, y: 32 bytes each)
+G_TABLE_MAGIC = b'PFGT'
+G_TABLE_HEADER = struct.Struct('<4sB32s')
+
+def build_g_table(window=WINDOW):
+    windows = -(-256 // window)
+    bases = [(G[0], G[1], 1)]
+    for _ in range(windows - 1):
+        pt = bases[-1]
+        for _ in range(window):
+            pt = jacobian_double(pt)
+        bases.append(pt)
+    bases = to_affine_batch(bases)
+
+    pts = []
+    for base in bases:
+        pt = (base[0], base[1], 1)
+        for _ in range((1 << window) - 1):
+            pts.append(pt)
+            pt = jacobian_add_affine(pt, base)
+    pts = to_affine_batch(pts)
+
+    n = (1 << window) - 1
+    return [pts[i:i + n] for i in range(0, len(pts), n)]
+
+def save_g_table(fname, table):
+    body = b''.join(x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+                    for row in table for x, y in row)
+    hdr = G_TABLE_HEADER.pack(G_TABLE_MAGIC, WINDOW, hashlib.sha256(body).digest())
+
+    # others may be loading it: never let them see a partial file
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp, 'wb') as fd:
+        fd.write(hdr + body)
+    os.replace(tmp, fname)
+
+def load_g_table(fname):
+    # table from file, or None if missing, damaged or made for another WINDOW
+    try:
+        with open(fname, 'rb') as fd:
+            data = fd.read()
+    except OSError:
+        return None
+
+    n = (1 << WINDOW) - 1
+    count = -(-256 // WINDOW) * n
+    hs = G_TABLE_HEADER.size
+    if len(data) != hs + (64 * count):
+        return None
+    magic, window, digest = G_TABLE_HEADER.unpack_from(data)
+    if magic != G_TABLE_MAGIC or window != WINDOW \
+            or hashlib.sha256(memoryview(data)[hs:]).digest() != digest:
+        return None
+
+    pts = [(int.from_bytes(data[i:i+32], 'big'), int.from_bytes(data[i+32:i+64], 'big'))
+           for i in range(hs, len(data), 64)]
+    if pts[0] != G:
+        return None
+    return [pts[i:i + n] for i in range(0, len(pts), n)]
+
+def _g_table():
+    global G_TABLE
+    if G_TABLE is None:
+        fname = os.environ.get(G_TABLE_ENV_VAR)
+        table = fname and load_g_table(fname)
+        if not table:
+            table = build_g_table()
+            if fname:
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+                    save_g_table(fname, table)
+                except OSError:
+                    pass
+        G_TABLE = table
+    return G_TABLE
+
+def mul_G(k):
+    # k*G in Jacobian coordinates, 0 < k < CURVE_ORDER: one add per non-zero window
+    mask = (1 << WINDOW) - 1
+    acc = (0, 1, 0)
+    for row in _g_table():
+        d = k & mask
+        if d:
+            acc = jacobian_add_affine(acc, row[d - 1])
+        k >>= WINDOW
+        if not k:
+            break
+    return acc
+
+
+class PythonBackend(ECBackend):
+    """pure Python, no dependencies; public keys are affine (x, y) tuples"""
+
+    name = 'python'
+    native = False
+
+    def _scalar(self, b32):
+        k = int.from_bytes(b32, 'big')
+        if not (0 < k < CURVE_ORDER):
+            raise ValueError("scalar out of range")
+        return k
+
+    def seckey_verify(self, seckey):
+        self._scalar(seckey)
+
+    def pubkey_create(self, seckey):
+        return to_affine_batch([mul_G(self._scalar(seckey))])[0]
+
+    def pubkey_parse(self, sec):
+        if len(sec) == 33 and sec[0] in (2, 3):
+            x = int.from_bytes(sec[1:], 'big')
+            # P % 4 == 3, so square root is a single pow()
+            y = pow((pow(x, 3, P) + 7) % P, (P + 1) // 4, P)
+            if (y & 1) != (sec[0] & 1):
+                y = P - y
+        elif len(sec) == 65 and sec[0] == 4:
+            x = int.from_bytes(sec[1:33], 'big')
+            y = int.from_bytes(sec[33:], 'big')
+        else:
+            raise ValueError("bad SEC public key")
+
+        if x >= P or (y * y - x * x * x - 7) % P:
+            raise ValueError("not on curve")
+        return (x, y)
+
+    def pubkey_serialize(self, pubkey, compressed=True):
+        x, y = pubkey
+        if compressed:
+            return bytes([2 + (y & 1)]) + x.to_bytes(32, 'big')
+        return b'\x04' + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+
+    def pubkey_tweak_add(self, pubkey, tweak32):
+        return self.pubkey_tweak_add_batch(pubkey, [tweak32])[0]
+
+    def pubkey_tweak_add_batch(self, pubkey, tweaks):
+        pts = [jacobian_add_affine(mul_G(self._scalar(t)), pubkey) for t in tweaks]
+        if any(not pt[2] for pt in pts):
+            raise ValueError("point at infinity")
+        return to_affine_batch(pts)
+
+    def seckey_tweak_add(self, seckey, tweak32):
+        t = int.from_bytes(tweak32, 'big')
+        if t >= CURVE_ORDER:
+            raise ValueError("tweak out of range")
+        k = (int.from_bytes(seckey, 'big') + t) % CURVE_ORDER
+        if not k:
+            raise ValueError("private key is zero")
+        return k.to_bytes(32, 'big')
+
+
+# fastest first
+BACKENDS = OrderedDict((cls.name, cls) for cls in
+                       (Secp256k1Backend, CoincurveBackend, PythonBackend))
+
+# old names still accepted
+ALIASES = {'ecdsa': 'python'}
+
+_instances = {}
+
+def get_backend(name):
+    # backend instance by name; ValueError if unknown or not installed here
+    name = ALIASES.get(name, name)
+    if name not in BACKENDS:
+        raise ValueError("unknown EC backend: %s (choose from: %s)"
+                         % (name, ', '.join(BACKENDS)))
+    if name not in _instances:
+        try:
+            _instances[name] = BACKENDS[name]()
+        except ImportError as exc:
+            raise ValueError("EC backend %s not available: %s" % (name, exc))
+    return _instances[name]
+
+def available_backends():
+    # names of the backends that work here, in order of preference
+    rv = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+            rv.append(name)
+        except ValueError:
+            pass
+    return rv
+
+def set_backend(name=None):
+    # pick backend by name (ValueError if it can't be used); default: env var, else
+    # first available - a bad env var only gets a warning, so import still works
+    # - keys made before keep working, each uses the backend that made it
+    global backend
+    if name is None:
+        name = os.environ.get(ENV_VAR)
+        if name:
+            try:
+                get_backend(name)
+            except ValueError as exc:
+                print("psbt_faker: ignoring %s: %s" % (ENV_VAR, exc), file=sys.stderr)
+                name = None
+        name = name or available_backends()[0]
+
+    backend = get_backend(name)
+    return backend
+
+def self_benchmark(names=None, n=50):
+    # {name: seconds per BIP-32 public derivation step} for the available backends
+    seckey = bytes(range(1, 33))
+    tweak = bytes(range(33, 65))
+    rv = {}
+    for name in (names or available_backends()):
+        be = get_backend(name)
+        pub = be.pubkey_create(seckey)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            pub = be.pubkey_tweak_add(pub, tweak)
+            be.pubkey_serialize(pub)
+        rv[name] = (time.perf_counter() - t0) / n
+    return rv
+
+def describe():
+    # one line about active backend, for humans
+    msg = "EC backend: " + backend.name
+    if not backend.native:
+        msg += " (pure Python, slow; install coincurve or pysecp256k1 for a big speedup)"
+    return msg
+
+backend = None
+set_backend()
+
+
+class TestPythonBackend(unittest.TestCase):
+    # pure Python curve arithmetic against the ecdsa library
+    #   python3 -m unittest psbt_faker.ec
+
+    def setUp(self):
+        from ecdsa import SECP256k1
+        self.gen = SECP256k1.generator
+        self.be = PythonBackend()
+        rng = random.Random(1)
+        # window edges, both ends of the range, and some random ones
+        self.scalars = [1, 2, 3, 255, 256, 257, (1 << 8*WINDOW) - 1, 1 << 128,
+                        (1 << 256) % CURVE_ORDER, CURVE_ORDER - 2, CURVE_ORDER - 1] \
+                        + [rng.randrange(1, CURVE_ORDER) for _ in range(20)]
+
+    def ref(self, k):
+        pt = self.gen * k
+        return (pt.x(), pt.y())
+
+    def test_pubkey_create(self):
+        for k in self.scalars:
+            self.assertEqual(self.be.pubkey_create(k.to_bytes(32, 'big')), self.ref(k), k)
+
+    def test_pubkey_tweak_add(self):
+        base = 0x1234567890abcdef
+        pub = self.be.pubkey_create(base.to_bytes(32, 'big'))
+        tweaks = [k.to_bytes(32, 'big') for k in self.scalars if k != CURVE_ORDER - base]
+        got = self.be.pubkey_tweak_add_batch(pub, tweaks)
+        for t, pt in zip(tweaks, got):
+            k = (base + int.from_bytes(t, 'big')) % CURVE_ORDER
+            self.assertEqual(pt, self.ref(k))
+            self.assertEqual(self.be.pubkey_tweak_add(pub, t), pt)
+
+        # tweak*G == pub: doubling inside the addition
+        self.assertEqual(self.be.pubkey_tweak_add(pub, base.to_bytes(32, 'big')),
+                         self.ref(2 * base))
+        # tweak*G == -pub: no such key
+        with self.assertRaises(ValueError):
+            self.be.pubkey_tweak_add(pub, (CURVE_ORDER - base).to_bytes(32, 'big'))
+        for bad in (0, CURVE_ORDER):
+            with self.assertRaises(ValueError):
+                self.be.pubkey_tweak_add(pub, bad.to_bytes(32, 'big'))
+
+    def test_seckey_tweak_add(self):
+        for k in self.scalars:
+            got = self.be.seckey_tweak_add(k.to_bytes(32, 'big'), (7).to_bytes(32, 'big'))
+            self.assertEqual(int.from_bytes(got, 'big'), (k + 7) % CURVE_ORDER)
+        with self.assertRaises(ValueError):
+            self.be.seckey_tweak_add((CURVE_ORDER - 7).to_bytes(32, 'big'),
+                                     (7).to_bytes(32, 'big'))
+
+    def test_sec(self):
+        for k in self.scalars:
+            x, y = self.ref(k)
+            comp = bytes([2 + (y & 1)]) + x.to_bytes(32, 'big')
+            full = b'\x04' + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+            for sec in (comp, full):
+                pub = self.be.pubkey_parse(sec)
+                self.assertEqual(pub, (x, y))
+                self.assertEqual(self.be.pubkey_serialize(pub, len(sec) == 33), sec)
+
+        # x with no point on the curve, x >= P, wrong y, wrong prefix
+        for bad in ['02' + '00' * 32, '02' + 'ff' * 32, '04' + '01' * 64,
+                    '05' + G[0].to_bytes(32, 'big').hex(), '02']:
+            with self.assertRaises(ValueError):
+                self.be.pubkey_parse(bytes.fromhex(bad))
+
+    def test_batch_inverse(self):
+        values = [1, 2, P - 1] + self.scalars
+        for v, vi in zip(values, batch_inverse(values)):
+            self.assertEqual(v * vi % P, 1)
+
+    def test_g_table(self):
+        # every entry of the table, not only those the scalars above happen to use
+        table = _g_table()
+        self.assertEqual(len(table), -(-256 // WINDOW))
+        for i, row in enumerate(table):
+            self.assertEqual(len(row), (1 << WINDOW) - 1)
+            self.assertEqual(row[0], self.ref(1 << (WINDOW * i)))
+            for d in range(1, len(row)):
+                self.assertEqual(row[d], to_affine_batch([jacobian_add_affine(
+                                    (row[d-1][0], row[d-1][1], 1), row[0])])[0])
+
+# EOF
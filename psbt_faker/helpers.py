@@ -1,5 +1,48 @@
 import struct, hashlib
-from .ripemd import ripemd160
+from .ripemd import ripemd160 as py_ripemd160
+
+# RIPEMD-160 providers, fastest first. Python's hashlib only has it when the
+# OpenSSL it was linked against does (OpenSSL 3.x moved it to the "legacy" provider).
+def _openssl_ripemd160(data):
+    return hashlib.new('ripemd160', data).digest()
+
+try:
+    from Crypto.Hash import RIPEMD160 as _Crypto_RIPEMD160
+except ImportError:
+    _Crypto_RIPEMD160 = None
+
+def _pycryptodome_ripemd160(data):
+    return _Crypto_RIPEMD160.new(data).digest()
+
+RIPEMD160_BACKENDS = {'openssl': _openssl_ripemd160}
+if _Crypto_RIPEMD160:
+    # only when pycryptodome is installed
+    RIPEMD160_BACKENDS['pycryptodome'] = _pycryptodome_ripemd160
+RIPEMD160_BACKENDS['python'] = py_ripemd160
+
+def ripemd160_backends():
+    # names of the backends that work here, in order of preference
+    rv = []
+    for name, fn in RIPEMD160_BACKENDS.items():
+        try:
+            assert fn(b'abc').hex() == '8eb208f7e05d987a9b044a8e98c6b087f15a0bfc'
+            rv.append(name)
+        except (ValueError, AssertionError):
+            pass
+    return rv
+
+def set_ripemd160_backend(name=None):
+    # pick RIPEMD-160 implementation used by hash160(); default is fastest available
+    global ripemd160, ripemd160_backend
+    if name is None:
+        name = ripemd160_backends()[0]
+    elif name not in ripemd160_backends():
+        raise ValueError('RIPEMD-160 backend not available: ' + name)
+
+    ripemd160 = RIPEMD160_BACKENDS[name]
+    ripemd160_backend = name
+
+set_ripemd160_backend()
 
 def str2ipath(s):
     # convert text to numeric path for BIP174
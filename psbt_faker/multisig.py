@@ -1,5 +1,7 @@
-import re
+import re, os, struct, hashlib, tempfile, unittest
 from .bip32 import BIP32Node
+from .helpers import str2path
+from .txn import multisig_script, ms_script_pubkey, cosigner_pubkeys
 
 def from_simple_text(lines):
     # standard multisig file format - more than one line
@@ -64,4 +66,215 @@ def from_simple_text(lines):
         elif len(label) == 8:
             xpubs.append((label, deriv, BIP32Node.from_hwif(value)))
 
-    return name, addr_fmt, xpubs, M, N
\ No newline at end of file
+    return name, addr_fmt, xpubs, M, N
+
+def config_fingerprint(M, keys, addr_fmt, bip67=True):
+    # identifies a multisig wallet: anything that changes its addresses is in here
+    h = hashlib.sha256(b'%d/%d/%s/%d' % (M, len(keys), addr_fmt.encode(), int(bip67)))
+    for xfp, str_path, node in keys:
+        h.update(xfp.encode() + b'/' + str(str_path).encode() + b'/')
+        h.update(node.node.serialize_public())
+    return h.digest()
+
+
+class MultisigAddressIndex:
+    # First `count` receive (0/*) and change (1/*) addresses of a multisig wallet,
+    # derived once: scriptPubKey, script and BIP-32 paths, as fake_ms_txn() needs them.
+    #
+    # Compact file form: header, then one fixed-size record per address:
+    #   N x (cosigner index, 33-byte pubkey) in script order, then scriptPubKey
+    # Scripts and paths are rebuilt from a record when first used.
+    MAGIC = b'PFMI'
+    VERSION = 1
+    HEADER = struct.Struct('<4sB32sBBBI')
+
+    def __init__(self, M, keys, addr_fmt="p2wsh", count=0, bip67=True, records=None):
+        self.M = M
+        self.keys = keys
+        self.addr_fmt = addr_fmt
+        self.count = count
+        self.bip67 = bip67
+        self.fingerprint = config_fingerprint(M, keys, addr_fmt, bip67)
+
+        # BIP-32 path of each cosigner's key, only chain/idx get added
+        self.prefixes = [str2path(xfp, str_path) for xfp, str_path, _ in keys]
+        self.spk_len = 34 if addr_fmt == "p2wsh" else 23
+        self.rec_size = (34 * len(keys)) + self.spk_len
+
+        self.records = self._build() if records is None else records
+        if len(self.records) != 2 * count * self.rec_size:
+            raise ValueError('address index has wrong size')
+        self._entries = {}
+
+    def _build(self):
+        rv = bytearray()
+        for chain in (0, 1):
+            for idx, pubkeys in enumerate(cosigner_pubkeys(self.keys, chain, 0, self.count)):
+                data = []
+                for cosigner_idx, pk in enumerate(pubkeys):
+                    assert len(pk) == 33
+                    data.append((pk, cosigner_idx))
+
+                if self.bip67:
+                    # same (stable) order as make_redeem()
+                    data.sort(key=lambda i: i[0])
+
+                script = multisig_script(self.M, [pk for pk, _ in data])
+                for pk, cosigner_idx in data:
+                    rv += bytes([cosigner_idx]) + pk
+                rv += ms_script_pubkey(script, self.addr_fmt)
+
+        return bytes(rv)
+
+    def get(self, idx, is_change):
+        # (scriptPubKey, script, [(pubkey, xfp_path), ...]) or None if not in index
+        if idx >= self.count:
+            return None
+
+        chain = int(bool(is_change))
+        rv = self._entries.get((chain, idx))
+        if rv is None:
+            pos = ((chain * self.count) + idx) * self.rec_size
+            rec = self.records[pos:pos + self.rec_size]
+            tail = struct.pack('<II', chain, idx)
+
+            details = []
+            for n in range(len(self.keys)):
+                off = n * 34
+                details.append((rec[off+1:off+34], self.prefixes[rec[off]] + tail))
+
+            script = multisig_script(self.M, [pk for pk, _ in details])
+            rv = self._entries[(chain, idx)] = (rec[-self.spk_len:], script, details)
+
+        return rv
+
+    def save(self, fname):
+        fmt = self.addr_fmt.encode()
+        hdr = self.HEADER.pack(self.MAGIC, self.VERSION, self.fingerprint, self.M,
+                               len(self.keys), int(self.bip67), self.count)
+        # others may be saving or loading it too: each writes its own temp file,
+        # and readers never see a partial one
+        tmp = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp, 'wb') as fd:
+            fd.write(hdr + bytes([len(fmt)]) + fmt)
+            fd.write(self.records)
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname, M, keys, addr_fmt="p2wsh", bip67=True):
+        # read index saved before; must be for this same wallet
+        with open(fname, 'rb') as fd:
+            raw = fd.read()
+
+        try:
+            magic, ver, fp, _, _, _, count = cls.HEADER.unpack_from(raw, 0)
+        except struct.error:
+            raise ValueError('not an address index: ' + fname)
+        if magic != cls.MAGIC or ver != cls.VERSION:
+            raise ValueError('not an address index: ' + fname)
+        if fp != config_fingerprint(M, keys, addr_fmt, bip67):
+            raise ValueError('address index is for another wallet: ' + fname)
+
+        pos = cls.HEADER.size
+        if pos >= len(raw):
+            raise ValueError('address index is truncated: ' + fname)
+        pos += 1 + raw[pos]
+
+        spk_len = 34 if addr_fmt == "p2wsh" else 23
+        rec_size = (34 * len(keys)) + spk_len
+        if len(raw) - pos != 2 * count * rec_size:
+            raise ValueError('address index is truncated or damaged: ' + fname)
+
+        return cls(M, keys, addr_fmt, count, bip67, records=raw[pos:])
+
+    @classmethod
+    def open(cls, fname, M, keys, addr_fmt="p2wsh", count=0, bip67=True):
+        # load index from file, if it is there and big enough, else build it and save there
+        try:
+            rv = cls.load(fname, M, keys, addr_fmt, bip67)
+            if rv.count >= count:
+                return rv
+        except (OSError, ValueError):
+            pass
+
+        rv = cls(M, keys, addr_fmt, count, bip67)
+        rv.save(fname)
+        return rv
+
+
+def _test_wallet(addr_fmt="p2wsh", M=2, N=3):
+    # (addr_fmt, keys, M) of a made-up wallet, for the tests here and in other modules
+    lines = ['Policy: %d of %d' % (M, N), 'Format: ' + addr_fmt, "Derivation: m/48h/1h/0h/2h"]
+    for i in range(N):
+        master = BIP32Node.from_master_secret(bytes([i + 1]) * 32)
+        lines.append('%s: %s' % (master.fingerprint().hex().upper(),
+                                 master.subkey_for_path("48h/1h/0h/2h").hwif()))
+    _, addr_fmt, keys, M, _ = from_simple_text(lines)
+    return addr_fmt, keys, M
+
+
+class TestAddressIndex(unittest.TestCase):
+    # python3 -m unittest psbt_faker.multisig
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmpdir.name, 'wallet.idx')
+        self.af, self.keys, self.M = _test_wallet()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def open(self, count=6, keys=None, M=None):
+        return MultisigAddressIndex.open(self.fname, M or self.M, keys or self.keys,
+                                         self.af, count=count)
+
+    def load(self):
+        return MultisigAddressIndex.load(self.fname, self.M, self.keys, self.af)
+
+    def test_same_psbt(self):
+        """Index only makes it faster: same PSBT with and without."""
+        from .txn import fake_ms_txn
+        for af in ('p2wsh', 'p2sh', 'p2sh-p2wsh'):
+            af, keys, M = _test_wallet(af)
+            idx = MultisigAddressIndex(M, keys, af, count=5)
+            args = (2, 3, M, keys)
+            kws = dict(change_af=af, change_outputs=[0, 1], seed=1)
+            self.assertEqual(bytes(fake_ms_txn(*args, addr_index=idx, **kws)[0]),
+                             bytes(fake_ms_txn(*args, **kws)[0]))
+
+    def test_reuse(self):
+        built = self.open()
+        self.assertEqual(self.load().records, built.records)
+
+        # big enough: used as is; too small: made again, bigger
+        self.assertEqual(self.open(count=4).count, 6)
+        self.assertEqual(self.open(count=9).count, 9)
+        self.assertEqual(self.load().count, 9)
+
+    def test_truncated(self):
+        """Cut-off file: ValueError from load(), open() makes it again."""
+        built = self.open()
+        size = os.path.getsize(self.fname)
+        for cut in (1, built.rec_size, size - MultisigAddressIndex.HEADER.size, size - 2):
+            with open(self.fname, 'r+b') as fd:
+                fd.truncate(size - cut)
+            with self.assertRaises(ValueError):
+                self.load()
+            self.assertEqual(self.open().records, built.records)
+            self.assertEqual(os.path.getsize(self.fname), size)
+
+        with open(self.fname, 'wb') as fd:
+            fd.write(b'junk')
+        self.assertEqual(self.open().records, built.records)
+
+    def test_other_wallet(self):
+        """Index of another wallet is never used."""
+        self.open()
+        af, keys, M = _test_wallet(M=1)
+        with self.assertRaisesRegex(ValueError, 'another wallet'):
+            MultisigAddressIndex.load(self.fname, M, keys, af)
+
+        other = self.open(keys=keys, M=M)
+        self.assertEqual(other.records, MultisigAddressIndex(M, keys, af, count=6).records)
+        with self.assertRaisesRegex(ValueError, 'another wallet'):
+            self.load()
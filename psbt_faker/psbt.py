@@ -2,11 +2,12 @@
 #
 # psbt.py - yet another PSBT parser/serializer but used only for test cases.
 #
-import io, struct
+import os, mmap, struct, shutil, tempfile, unittest
+from collections.abc import Sequence
 from binascii import b2a_hex as _b2a_hex
 from binascii import a2b_hex
 from base64 import b64decode, b64encode
-from .serialize import ser_compact_size, deser_compact_size
+from .serialize import ser_compact_size, deser_compact_size, deser_compact_size_from
 from .ctransaction import CTransaction, CTxOut, CTxIn, COutPoint, uint256_from_str, ser_uint256
 
 b2a_hex = lambda a: str(_b2a_hex(a), 'ascii')
@@ -80,6 +81,77 @@ def ser_prop_key(identifier, subtype, keydata=b''):
     return key
 
 
+def read_kv(buf, pos):
+    # next key/value pair of a section, at offset pos of buf: (key, value, new pos)
+    # - key is None at end of section
+    # - key is copied (small, used in dicts), value is a slice: no copy for memoryview
+    ks, pos = deser_compact_size_from(buf, pos)
+    # every section ends with a separator, running out of data before it is truncation
+    assert ks is not None, 'truncated'
+    if not ks:
+        return None, None, pos
+
+    key = bytes(buf[pos:pos+ks])
+    vs, pos = deser_compact_size_from(buf, pos+ks)
+    # slicing would quietly give a short value; caller then sees junk where next key was
+    assert vs is not None and pos+vs <= len(buf), 'truncated'
+
+    return key, buf[pos:pos+vs], pos+vs
+
+def skip_section(buf, pos):
+    # offset just past the section at pos, without decoding any of it
+    while 1:
+        ks, pos = deser_compact_size_from(buf, pos)
+        assert ks is not None, 'truncated'
+        if not ks:
+            return pos
+
+        vs, pos = deser_compact_size_from(buf, pos + ks)
+        assert vs is not None and pos + vs <= len(buf), 'truncated'
+        pos += vs
+
+def txn_io_counts(buf):
+    # number of inputs and outputs of serialized txn, without deserializing all of it
+    def skip_str(pos):
+        ln, pos = deser_compact_size_from(buf, pos)
+        return pos + ln
+
+    num_ins, pos = deser_compact_size_from(buf, 4)
+    if num_ins == 0:
+        # segwit marker, flags
+        num_ins, pos = deser_compact_size_from(buf, pos+1)
+
+    for _ in range(num_ins):
+        pos = skip_str(pos + 36) + 4        # outpoint, scriptSig, sequence
+
+    num_outs, pos = deser_compact_size_from(buf, pos)
+
+    return num_ins, num_outs
+
+
+# key types as bytes, ready to use
+_KTYPES = tuple(bytes([i]) for i in range(256))
+
+class KVWriter:
+    "Collects key/value pairs, then lays them out in one buffer"
+
+    def __init__(self):
+        self.parts = []
+
+    def __call__(self, ktype, val, key=b''):
+        # same signature as wr() given to serialize_kvs
+        self.parts += (ser_compact_size(1 + len(key)), _KTYPES[ktype], key,
+                       ser_compact_size(len(val)), val)
+
+    def raw(self, data):
+        # magic, separators
+        self.parts.append(data)
+
+    def getbuffer(self):
+        # join() sizes the result first, then copies each part exactly once
+        return b''.join(self.parts)
+
+
 class PSBTSection:
 
     def __init__(self, fd=None, idx=None):
@@ -100,17 +172,25 @@ class PSBTSection:
             kt = key[0]
             self.parse_kv(kt, key[1:], val)
 
-    def serialize(self, fd, v2):
+    def parse_buf(self, buf, pos):
+        # parse section at offset pos of buf, returns offset just past it
+        while 1:
+            key, val, pos = read_kv(buf, pos)
+            if key is None: break
 
-        def wr(ktype, val, key=b''):
-            fd.write(ser_compact_size(1 + len(key)))
-            fd.write(bytes([ktype]) + key)
-            fd.write(ser_compact_size(len(val)))
-            fd.write(val)
+            self.parse_kv(key[0], key[1:], val)
 
-        self.serialize_kvs(wr, v2)
+        return pos
 
-        fd.write(b'\0')
+    def serialize(self, fd, v2):
+        wr = KVWriter()
+        self.serialize_into(wr, v2)
+        fd.write(wr.getbuffer())
+
+    def serialize_into(self, wr, v2):
+        # add whole section, including separator, to a KVWriter
+        self.serialize_kvs(wr, v2)
+        wr.raw(b'\0')
 
 
 class BasicPSBTInput(PSBTSection):
@@ -338,6 +418,31 @@ class BasicPSBTOutput(PSBTSection):
                 wr(key[0], val, key[1:])
 
 
+class LazySections(Sequence):
+    "Input or output sections of a PSBT, each decoded only when first indexed"
+
+    def __init__(self, cls, buf, offsets):
+        self.cls = cls
+        self.buf = buf
+        self.offsets = offsets
+        self.decoded = [None] * len(offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        rv = self.decoded[idx]
+        if rv is None:
+            # idx may be negative, but my_index must not be
+            rv = self.cls(idx=range(len(self))[idx])
+            rv.parse_buf(self.buf, self.offsets[idx])
+            self.decoded[idx] = rv
+        return rv
+
+
 class BasicPSBT:
     "Just? parse and store"
 
@@ -353,7 +458,7 @@ class BasicPSBT:
         self.txn_modifiable = None
         self.fallback_locktime = None
         self.unknown = {}
-        self.parsed_txn = None
+        self._parsed_txn = None
 
     def __eq__(a, b):
         return a.txn == b.txn and \
@@ -372,88 +477,127 @@ class BasicPSBT:
     def is_v2(self):
         return (self.version == 2) or (not self.txn)
 
-    def parse(self, raw):
+    @property
+    def parsed_txn(self):
+        # unsigned txn of v0 PSBT as CTransaction; decoded only when first needed
+        if self._parsed_txn is None and self.txn:
+            t = CTransaction()
+            t.deserialize_from(self.txn)
+            self._parsed_txn = t
+        return self._parsed_txn
+
+    @parsed_txn.setter
+    def parsed_txn(self, t):
+        self._parsed_txn = t
+
+    def parse(self, raw, lazy=False):
+        # raw can be bytes, or memoryview/mmap for zero-copy parsing: values then
+        # are memoryview slices into it and are copied only when caller does bytes(...)
+        # - lazy: only find where each input/output section is, decode them when indexed
+        zero_copy = isinstance(raw, (memoryview, mmap.mmap))
+        if isinstance(raw, str):
+            raw = raw.encode()
+
         # auto-detect and decode Base64 and Hex.
-        if raw[0:10].lower() == b'70736274ff':
-            raw = a2b_hex(raw.strip())
-        if raw[0:6] == b'cHNidP':
+        if bytes(raw[0:10]).lower() == b'70736274ff':
+            raw = a2b_hex(bytes(raw).strip())
+        elif bytes(raw[0:6]) == b'cHNidP':
             raw = b64decode(raw)
-        assert raw[0:5] == b'psbt\xff', "bad magic {}".format(raw[0:5])
-        with io.BytesIO(raw[5:]) as fd:
-
-            # globals
-            while 1:
-                ks = deser_compact_size(fd)
-                if ks is None: break
-
-                if ks == 0: break
-
-                key = fd.read(ks)
-                vs = deser_compact_size(fd)
-                val = fd.read(vs)
-
-                kt = key[0]
-                if kt == PSBT_GLOBAL_UNSIGNED_TX:
-                    self.txn = val
-
-                    t = CTransaction()
-                    t.deserialize(io.BytesIO(val))
-                    self.parsed_txn = t
-                    num_ins = len(t.vin)
-                    num_outs = len(t.vout)
-                elif kt == PSBT_GLOBAL_XPUB:
-                    # key=(xpub) => val=(path)
-                    # ignore PSBT_GLOBAL_XPUB on 0th index (should not be part of parsed key)
-                    self.xpubs.append((key[1:], val))
-                elif kt == PSBT_GLOBAL_VERSION:
-                    self.version = struct.unpack("<I", val)[0]
-                elif kt == PSBT_GLOBAL_TX_VERSION:
-                    self.txn_version = struct.unpack("<I", val)[0]
-                elif kt == PSBT_GLOBAL_FALLBACK_LOCKTIME:
-                    self.fallback_locktime = struct.unpack("<I", val)[0]
-                elif kt == PSBT_GLOBAL_INPUT_COUNT:
-                    self.input_count = deser_compact_size(io.BytesIO(val))
-                    num_ins = self.input_count
-                elif kt == PSBT_GLOBAL_OUTPUT_COUNT:
-                    self.output_count = deser_compact_size(io.BytesIO(val))
-                    num_outs = self.output_count
-                elif kt == PSBT_GLOBAL_TX_MODIFIABLE:
-                    self.txn_modifiable = val[0]
-                else:
-                    self.unknown[key] = val
-
-            if self.version is None:
-                # decide version based on PSBT_GLOBAL_UNSIGNED_TX field
-                # v0 requires inclusion
-                # v2 requires exclusion
-                self.version = 0 if self.txn else 2
-
-            if self.version == 0:
-                assert self.txn, 'v0: missing reqd section - PSBT_GLOBAL_UNSIGNED_TX'
-            elif self.version == 2:
-                # tx version needs to be at least 2 because locktimes
-                assert self.txn_version == 2, 'v2: missing reqd section - PSBT_GLOBAL_TX_VERSION'
-                assert self.input_count is not None, 'v2: missing reqd section - PSBT_GLOBAL_INPUT_COUNT'
-                assert self.output_count is not None, 'v2: missing reqd section - PSBT_GLOBAL_OUTPUT_COUNT'
-
-            self.inputs = [BasicPSBTInput(fd, idx) for idx in range(num_ins)]
-            self.outputs = [BasicPSBTOutput(fd, idx) for idx in range(num_outs)]
-
-            sep = fd.read(1)
-            assert sep == b''
+        elif zero_copy:
+            raw = memoryview(raw)
+        elif not isinstance(raw, bytes):
+            raw = bytes(raw)
+
+        assert raw[0:5] == b'psbt\xff', "bad magic {}".format(bytes(raw[0:5]))
+        pos = 5
+
+        # globals
+        while 1:
+            key, val, pos = read_kv(raw, pos)
+            if key is None: break
+
+            kt = key[0]
+            if kt == PSBT_GLOBAL_UNSIGNED_TX:
+                self.txn = val
+                num_ins, num_outs = txn_io_counts(val)
+            elif kt == PSBT_GLOBAL_XPUB:
+                # key=(xpub) => val=(path)
+                # ignore PSBT_GLOBAL_XPUB on 0th index (should not be part of parsed key)
+                self.xpubs.append((key[1:], val))
+            elif kt == PSBT_GLOBAL_VERSION:
+                self.version = struct.unpack("<I", val)[0]
+            elif kt == PSBT_GLOBAL_TX_VERSION:
+                self.txn_version = struct.unpack("<I", val)[0]
+            elif kt == PSBT_GLOBAL_FALLBACK_LOCKTIME:
+                self.fallback_locktime = struct.unpack("<I", val)[0]
+            elif kt == PSBT_GLOBAL_INPUT_COUNT:
+                self.input_count = deser_compact_size_from(val, 0)[0]
+                num_ins = self.input_count
+            elif kt == PSBT_GLOBAL_OUTPUT_COUNT:
+                self.output_count = deser_compact_size_from(val, 0)[0]
+                num_outs = self.output_count
+            elif kt == PSBT_GLOBAL_TX_MODIFIABLE:
+                self.txn_modifiable = val[0]
+            else:
+                self.unknown[key] = val
+
+        if self.version is None:
+            # decide version based on PSBT_GLOBAL_UNSIGNED_TX field
+            # v0 requires inclusion
+            # v2 requires exclusion
+            self.version = 0 if self.txn else 2
+
+        if self.version == 0:
+            assert self.txn, 'v0: missing reqd section - PSBT_GLOBAL_UNSIGNED_TX'
+        elif self.version == 2:
+            # tx version needs to be at least 2 because locktimes
+            assert self.txn_version == 2, 'v2: missing reqd section - PSBT_GLOBAL_TX_VERSION'
+            assert self.input_count is not None, 'v2: missing reqd section - PSBT_GLOBAL_INPUT_COUNT'
+            assert self.output_count is not None, 'v2: missing reqd section - PSBT_GLOBAL_OUTPUT_COUNT'
+
+        if lazy:
+            offsets = []
+            for _ in range(num_ins + num_outs):
+                offsets.append(pos)
+                pos = skip_section(raw, pos)
+
+            self.inputs = LazySections(BasicPSBTInput, raw, offsets[:num_ins])
+            self.outputs = LazySections(BasicPSBTOutput, raw, offsets[num_ins:])
+        else:
+            self.inputs = []
+            for idx in range(num_ins):
+                inp = BasicPSBTInput(idx=idx)
+                pos = inp.parse_buf(raw, pos)
+                self.inputs.append(inp)
+
+            self.outputs = []
+            for idx in range(num_outs):
+                outp = BasicPSBTOutput(idx=idx)
+                pos = outp.parse_buf(raw, pos)
+                self.outputs.append(outp)
+
+        assert pos == len(raw), 'junk after PSBT'
 
         return self
 
+    def parse_file(self, fname, lazy=False):
+        # zero-copy parse of a (binary) PSBT file, via mmap
+        with open(fname, 'rb') as fd:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.parse(mm, lazy=lazy)
+
     def serialize(self, fd):
-        v2 = self.is_v2()
-        def wr(ktype, val, key=b''):
-            ktype_plus_key = bytes([ktype]) + key
-            fd.write(ser_compact_size(len(ktype_plus_key)))
-            fd.write(ktype_plus_key)
-            fd.write(ser_compact_size(len(val)))
-            fd.write(val)
+        fd.write(self.as_bytes())
 
-        fd.write(b'psbt\xff')
+    def serialize_globals(self, fd, v2):
+        # magic, global section and its separator; inputs and outputs follow
+        wr = KVWriter()
+        self.serialize_globals_into(wr, v2)
+        fd.write(wr.getbuffer())
+
+    def serialize_globals_into(self, wr, v2):
+        wr.raw(b'psbt\xff')
 
         if (not v2) and self.txn:
             wr(PSBT_GLOBAL_UNSIGNED_TX, self.txn)
@@ -490,36 +634,41 @@ class BasicPSBT:
                 wr(key[0], val, key[1:])
 
         # sep
-        fd.write(b'\0')
+        wr.raw(b'\0')
+
+    def as_bytes(self):
+        # whole PSBT, built as a single buffer
+        v2 = self.is_v2()
+
+        wr = KVWriter()
+        self.serialize_globals_into(wr, v2)
 
         for idx, inp in enumerate(self.inputs):
-            inp.serialize(fd, v2)
+            inp.serialize_into(wr, v2)
 
         for idx, outp in enumerate(self.outputs):
-            outp.serialize(fd, v2)
+            outp.serialize_into(wr, v2)
 
-    def as_bytes(self):
-        with io.BytesIO() as fd:
-            self.serialize(fd)
-            return fd.getvalue()
+        return wr.getbuffer()
 
     def as_b64_str(self):
         return b64encode(self.as_bytes()).decode()
 
     def to_v2(self):
         if self.version is None or self.version == 0:
+            t = self.parsed_txn
             self.version = 2
             self.txn_version = 2
             self.txn = None
-            self.input_count = len(self.parsed_txn.vin)
-            self.output_count = len(self.parsed_txn.vout)
-            self.fallback_locktime = self.parsed_txn.nLockTime
-            for idx, inp in enumerate(self.parsed_txn.vin):
+            self.input_count = len(t.vin)
+            self.output_count = len(t.vout)
+            self.fallback_locktime = t.nLockTime
+            for idx, inp in enumerate(t.vin):
                 i = self.inputs[idx]
                 i.previous_txid = ser_uint256(inp.prevout.hash)
                 i.prevout_idx = inp.prevout.n
                 i.sequence = inp.nSequence
-            for idx, out in enumerate(self.parsed_txn.vout):
+            for idx, out in enumerate(t.vout):
                 o = self.outputs[idx]
                 o.script = out.scriptPubKey
                 o.amount = out.nValue
@@ -560,6 +709,35 @@ class BasicPSBT:
         return self.as_bytes()
 
 
+class PSBTStreamWriter:
+    "Write input/output sections as they are made, so they need not be kept around"
+
+    def __init__(self, fd, psbt, spool_size=1 << 20):
+        # psbt provides the globals only; its inputs/outputs lists are not used
+        self.fd = fd
+        self.psbt = psbt
+        self.v2 = (psbt.version == 2)
+
+        if self.v2:
+            # v2 globals only have counts, so they can go first
+            psbt.serialize_globals(fd, True)
+            self.body = fd
+        else:
+            # v0 globals hold whole unsigned txn, which is done only at the end;
+            # park the sections meanwhile (spills to disk past spool_size)
+            self.body = tempfile.SpooledTemporaryFile(max_size=spool_size)
+
+    def add(self, section):
+        section.serialize(self.body, self.v2)
+
+    def finish(self):
+        if self.body is not self.fd:
+            self.psbt.serialize_globals(self.fd, False)
+            self.body.seek(0)
+            shutil.copyfileobj(self.body, self.fd)
+            self.body.close()
+
+
 def test_my_psbt():
     import glob, io
 
@@ -579,4 +757,70 @@ def test_my_psbt():
         chk = BasicPSBT().parse(fd.getvalue())
         assert chk == p
 
+
+class TestParse(unittest.TestCase):
+    # python3 -m unittest psbt_faker.psbt
+
+    @classmethod
+    def setUpClass(cls):
+        from . import SIM_XPUB
+        from .txn import fake_txn, fake_ms_txn
+        from .multisig import _test_wallet
+
+        cls.samples = [
+            fake_txn(3, 3, SIM_XPUB, change_outputs=[0], seed=1)[0],
+            fake_txn(2, 2, SIM_XPUB, segwit_in=True, wrapped=True, change_outputs=[1],
+                     locktime=7, seed=2)[0],
+            fake_txn(2, 3, SIM_XPUB, segwit_in=True, psbt_v2=True, change_outputs=[0],
+                     op_return=[(0, b'hi')], seed=3)[0],
+        ]
+        for af, v2 in [('p2wsh', False), ('p2sh', True)]:
+            af, keys, M = _test_wallet(af)
+            cls.samples.append(fake_ms_txn(2, 2, M, keys, change_af=af, change_outputs=[0],
+                                           psbt_v2=v2, incl_xpubs=True, seed=4)[0])
+        cls.samples = [bytes(raw) for raw in cls.samples]
+
+    def forms(self, raw, tmpdir):
+        # same PSBT in each form parse() takes: (label, parse function)
+        fname = os.path.join(tmpdir, 'x.psbt')
+        with open(fname, 'wb') as fd:
+            fd.write(raw)
+
+        for lazy in (False, True):
+            for form in (raw, bytearray(raw), memoryview(raw),
+                         b64encode(raw), raw.hex().encode()):
+                yield (type(form).__name__, lazy), \
+                      lambda form=form, lazy=lazy: BasicPSBT().parse(form, lazy=lazy)
+            yield ('mmap', lazy), lambda lazy=lazy: BasicPSBT().parse_file(fname, lazy=lazy)
+
+    def test_forms(self):
+        """Eager, lazy, bytes, memoryview, mmap...: same PSBT every time."""
+        for raw in self.samples:
+            ref = BasicPSBT().parse(raw)
+            canon = ref.as_bytes()
+            v2 = BasicPSBT().parse(raw).to_v2()
+            v0 = BasicPSBT().parse(raw).to_v0()
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                for label, parse in self.forms(raw, tmpdir):
+                    with self.subTest(form=label):
+                        p = parse()
+                        self.assertEqual(list(p.inputs), list(ref.inputs))
+                        self.assertEqual(list(p.outputs), list(ref.outputs))
+                        self.assertEqual(p.as_bytes(), canon)
+                        self.assertEqual(parse().to_v2(), v2)
+                        self.assertEqual(parse().to_v0(), v0)
+
+    def test_truncated(self):
+        """Cut anywhere after the magic: 'truncated', not 'junk after PSBT'."""
+        for raw in self.samples:
+            for form in (raw, memoryview(raw)):
+                for lazy in (False, True):
+                    for n in range(5, len(raw)):
+                        with self.assertRaisesRegex(AssertionError, '^truncated'):
+                            BasicPSBT().parse(form[:n], lazy=lazy)
+
+            with self.assertRaisesRegex(AssertionError, 'junk after PSBT'):
+                BasicPSBT().parse(raw + b'\0')
+
 # EOF
@@ -31,15 +31,25 @@ class Encoding(Enum):
 CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
 BECH32M_CONST = 0x2bc830a3
 
-def bech32_polymod(values):
-    """Internal function that computes the Bech32 checksum."""
+def _polymod_table():
+    """XOR of the generator terms selected by each possible 5-bit top value."""
     generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
-    chk = 1
-    for value in values:
-        top = chk >> 25
-        chk = (chk & 0x1ffffff) << 5 ^ value
+    table = []
+    for top in range(32):
+        t = 0
         for i in range(5):
-            chk ^= generator[i] if ((top >> i) & 1) else 0
+            if (top >> i) & 1:
+                t ^= generator[i]
+        table.append(t)
+    return tuple(table)
+
+POLYMOD_TABLE = _polymod_table()
+
+def bech32_polymod(values, chk=1):
+    """Internal function that computes the Bech32 checksum."""
+    table = POLYMOD_TABLE
+    for value in values:
+        chk = table[chk >> 25] ^ ((chk & 0x1ffffff) << 5) ^ value
     return chk
 
 
@@ -128,8 +138,35 @@ def decode(hrp, addr):
     return (data[0], decoded)
 
 
-def encode(hrp, witver, witprog):
+_hrp_states = {}
+
+def _hrp_polymod(hrp):
+    """Checksum state after the (expanded) HRP; same few HRPs are used over and over."""
+    chk = _hrp_states.get(hrp)
+    if chk is None:
+        chk = _hrp_states[hrp] = bech32_polymod(bech32_hrp_expand(hrp))
+    return chk
+
+def witprog_to_5bit(witprog):
+    """convertbits(witprog, 8, 5) for bytes, done on one big integer."""
+    nbits = 8 * len(witprog)
+    count = (nbits + 4) // 5
+    acc = int.from_bytes(witprog, 'big') << (5 * count - nbits)
+    return [(acc >> (5 * i)) & 31 for i in range(count - 1, -1, -1)]
+
+def encode_trusted(hrp, witver, witprog):
+    """Encode a segwit address for a witness program we made ourselves: no round-trip decode."""
+    const = BECH32M_CONST if witver else 1
+    data = [witver] + witprog_to_5bit(witprog)
+    chk = bech32_polymod(data + [0, 0, 0, 0, 0, 0], _hrp_polymod(hrp)) ^ const
+    return (hrp + '1' + ''.join([CHARSET[d] for d in data])
+            + ''.join([CHARSET[(chk >> 5 * (5 - i)) & 31] for i in range(6)]))
+
+def encode(hrp, witver, witprog, trusted=False):
     """Encode a segwit address."""
+    if trusted:
+        return encode_trusted(hrp, witver, witprog)
+
     spec = Encoding.BECH32 if witver == 0 else Encoding.BECH32M
     ret = bech32_encode(hrp, [witver] + convertbits(witprog, 8, 5), spec)
     if decode(hrp, ret) == (None, None):
@@ -13,11 +13,21 @@ Bitcoin repository
 """
 
 import struct
-from struct import error as struct_err
 from typing import List
 
 
 # Serialization/deserialization tools
+
+# encodings of all sizes that fit in a single byte, most common case by far
+_COMPACT_SIZE_1 = tuple(bytes([i]) for i in range(253))
+_PACK_FD = struct.Struct("<BH").pack
+_PACK_FE = struct.Struct("<BI").pack
+_PACK_FF = struct.Struct("<BQ").pack
+# unpack_from() for the 2, 4 or 8 bytes after 0xfd, 0xfe or 0xff marker
+_UNPACK_FROM = {253: struct.Struct("<H").unpack_from,
+                254: struct.Struct("<I").unpack_from,
+                255: struct.Struct("<Q").unpack_from}
+
 def ser_compact_size(size: int) -> bytes:
     """
     Serialize an integer using Bitcoin's compact size unsigned integer serialization.
@@ -25,16 +35,14 @@ def ser_compact_size(size: int) -> bytes:
     :param size: The int to serialize
     :returns: The int serialized as a compact size unsigned integer
     """
-    r = b""
     if size < 253:
-        r = struct.pack("B", size)
+        return _COMPACT_SIZE_1[size]
     elif size < 0x10000:
-        r = struct.pack("<BH", 253, size)
+        return _PACK_FD(253, size)
     elif size < 0x100000000:
-        r = struct.pack("<BI", 254, size)
+        return _PACK_FE(254, size)
     else:
-        r = struct.pack("<BQ", 255, size)
-    return r
+        return _PACK_FF(255, size)
 
 def deser_compact_size(f):
     """
@@ -43,18 +51,44 @@ def deser_compact_size(f):
     :param f: The byte stream
     :returns: The integer that was serialized
     """
-    try:
-        nit: int = struct.unpack("<B", f.read(1))[0]
-    except struct_err:
+    b = f.read(1)
+    if not b:
         return None
 
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    return nit
+    nit = b[0]
+    if nit < 253:
+        return nit
+
+    return _UNPACK_FROM[nit](f.read(1 << (nit - 252)))[0]
+
+def deser_compact_size_from(buf, pos: int):
+    """
+    Deserialize a compact size unsigned integer at an offset of a buffer, without copying it.
+
+    :param buf: bytes, memoryview or other buffer
+    :param pos: offset of the compact size in buf
+    :returns: The integer that was serialized (or None at end of buffer) and offset just after it
+    """
+    if pos >= len(buf):
+        return None, pos
+
+    nit = buf[pos]
+    if nit < 253:
+        return nit, pos + 1
+
+    # 2, 4 or 8 bytes follow
+    return _UNPACK_FROM[nit](buf, pos + 1)[0], pos + 1 + (1 << (nit - 252))
+
+def deser_string_from(buf, pos: int):
+    """
+    Deserialize a variable length byte string at an offset of a buffer.
+
+    :param buf: bytes, memoryview or other buffer
+    :param pos: offset of the serialized string in buf
+    :returns: The byte string (slice of buf) and offset just after it
+    """
+    nit, pos = deser_compact_size_from(buf, pos)
+    return buf[pos:pos+nit], pos + nit
 
 def deser_string(f) -> bytes:
     """
@@ -82,13 +116,11 @@ def deser_uint256(f) -> int:
     :param f: The byte stream.
     :returns: The integer that was serialized
     """
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return int.from_bytes(f.read(32), "little")
 
 
+_UINT256_MASK = (1 << 256) - 1
+
 def ser_uint256(u: int) -> bytes:
     """
     Serialize a 256 bit integer with Bitcoin's 256 bit integer serialization.
@@ -96,11 +128,7 @@ def ser_uint256(u: int) -> bytes:
     :param u: The integer to serialize
     :returns: The serialized 256 bit integer
     """
-    rs = b""
-    for _ in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & _UINT256_MASK).to_bytes(32, "little")
 
 
 def uint256_from_str(s: bytes) -> int:
@@ -110,11 +138,7 @@ def uint256_from_str(s: bytes) -> int:
     :param s: The byte string
     :returns: The integer that was serialized
     """
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], "little")
 
 
 def deser_vector(f, c) -> List:
@@ -147,6 +171,21 @@ def ser_vector(v) -> bytes:
     return r
 
 
+def deser_string_vector_from(buf, pos: int):
+    """
+    Deserialize a vector of byte strings at an offset of a buffer.
+
+    :param buf: bytes, memoryview or other buffer
+    :param pos: offset of the serialized vector in buf
+    :returns: The list of byte strings and offset just after it
+    """
+    nit, pos = deser_compact_size_from(buf, pos)
+    r = []
+    for _ in range(nit):
+        t, pos = deser_string_from(buf, pos)
+        r.append(t)
+    return r, pos
+
 def deser_string_vector(f) -> List[bytes]:
     """
     Deserialize a vector of byte strings from a byte stream.
@@ -0,0 +1,142 @@
+#
+# Where does generation time go: wall time per phase (key parsing, derivation, hashing...)
+#
+# Code marks the end of each phase with active.lap(name); the time since the previous
+# lap is added to that phase. Nothing is measured unless a PhaseTimer is active:
+# by default `active` is a NullTimer whose methods do nothing.
+#
+#   with PhaseTimer() as timer:
+#       fake_txn(...)
+#   print(timer.report())
+#
+import sys
+from time import perf_counter_ns
+from contextlib import contextmanager
+
+
+class NullTimer:
+    # stand-in when not profiling; all no-ops
+
+    def __bool__(self):
+        return False
+
+    def lap(self, name):
+        pass
+
+    def add(self, name, ns):
+        pass
+
+    def wrap_file(self, fd):
+        return fd
+
+NULL = NullTimer()
+
+# timer that library code reports to
+active = NULL
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.totals = {}        # phase => ns
+        self.counts = {}        # phase => number of laps
+        self.started = self.last = None
+        self.ended = None
+        self.carved = 0         # ns since last lap already added to other phases
+        self.prev = None
+
+    def start(self):
+        self.started = self.last = perf_counter_ns()
+        self.ended = None
+
+    def lap(self, name):
+        # time since previous lap belongs to phase `name`
+        now = perf_counter_ns()
+        self.totals[name] = self.totals.get(name, 0) + (now - self.last - self.carved)
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.last = now
+        self.carved = 0
+
+    def add(self, name, ns):
+        # ns spent on `name` in the middle of some other phase, measured by caller
+        self.totals[name] = self.totals.get(name, 0) + ns
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.carved += ns
+
+    def wrap_file(self, fd):
+        # file object whose writes are timed as phase "write"
+        return TimedFile(fd, self)
+
+    def __enter__(self):
+        global active
+        self.prev, active = active, self
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        global active
+        # anything after last lap
+        self.lap('other')
+        self.ended = self.last
+        active, self.prev = self.prev, None
+
+    def total(self):
+        return (self.ended or perf_counter_ns()) - self.started
+
+    def report(self):
+        # table of phases, biggest first
+        total = self.total()
+        lines = [f"{'phase':16s} {'ms':>10s} {'%':>6s} {'laps':>7s}"]
+        for name, ns in sorted(self.totals.items(), key=lambda kv: -kv[1]):
+            if name == 'other' and ns < total // 1000:
+                continue
+            lines.append(f"{name:16s} {ns / 1e6:10.3f} {100 * ns / total:5.1f}% "
+                         f"{self.counts[name]:7d}")
+        lines.append(f"{'total':16s} {total / 1e6:10.3f}")
+        return '\n'.join(lines)
+
+
+class TimedFile:
+    # proxy for a binary file, write() time goes into phase "write"
+    def __init__(self, fd, timer):
+        self.fd = fd
+        self.timer = timer
+
+    def write(self, data):
+        t0 = perf_counter_ns()
+        rv = self.fd.write(data)
+        self.timer.add('write', perf_counter_ns() - t0)
+        return rv
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+
+@contextmanager
+def profiling(phases=False, cprofile_fname=None, out=sys.stderr):
+    # CLI helper: per-phase breakdown printed to out at the end, and/or
+    # full cProfile statistics saved into cprofile_fname (read with pstats)
+    cprof = None
+    if cprofile_fname:
+        import cProfile
+        cprof = cProfile.Profile()
+
+    timer = PhaseTimer() if phases else None
+    try:
+        if cprof:
+            cprof.enable()
+        if timer:
+            with timer:
+                yield timer
+        else:
+            yield NULL
+    finally:
+        if cprof:
+            cprof.disable()
+            cprof.dump_stats(cprofile_fname)
+        if timer:
+            print("\n" + timer.report(), file=out)
+        if cprof:
+            print(f"cProfile statistics: {cprofile_fname} (python3 -m pstats {cprofile_fname})",
+                  file=out)
+
+# EOF
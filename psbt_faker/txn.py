@@ -1,14 +1,15 @@
 #
 # Creating fake transactions. Not simple... but only for testing purposes, so ....
 #
-import struct, random, hashlib
-from io import BytesIO
+import io, struct, random, hashlib, unittest
+from collections.abc import Sequence
 from .segwit_addr import encode as bech32_encode
-from .psbt import BasicPSBT, BasicPSBTInput, BasicPSBTOutput
+from .psbt import BasicPSBT, BasicPSBTInput, BasicPSBTOutput, PSBTStreamWriter
 from .base58 import encode_base58_checksum
 from .helpers import str2path, hash160
 from .serialize import uint256_from_str
-from .bip32 import BIP32Node
+from .wallet import wallet_for
+from . import timing
 from .ctransaction import CTransaction, CTxIn, CTxOut, COutPoint
 
 # all possible addr types, including multisig/scripts
@@ -19,49 +20,74 @@ ADDR_STYLES_MULTI = ['p2wsh', 'p2sh', 'p2sh-p2wsh', 'p2wsh-p2sh']
 
 ADDR_STYLES = ADDR_STYLES_MULTI + ADDR_STYLES_SINGLE
 
-def prandom(count):
-    # make some bytes, randomly, but not: deterministic
-    return bytes(random.randint(0, 255) for i in range(count))
+def make_rng(seed=None):
+    # source of randomness for one PSBT
+    # - seed: int (reproducible), random.Random instance, or None for the global 'random' state
+    if seed is None:
+        return random
+    if isinstance(seed, random.Random):
+        return seed
+    return random.Random(seed)
 
-def fake_dest_addr(style='p2pkh'):
+def prandom(count, rng=random):
+    # make some bytes, randomly, but not: deterministic
+    # - one draw from the PRNG, not one per byte
+    if not count:
+        return b''
+    return rng.getrandbits(8 * count).to_bytes(count, 'little')
+
+# Plausible output scripts, but random garbage inside: (prefix, random bytes, suffix)
+# See CTxOut.get_address() in ../shared/serializations
+_P2SH_DEST = (bytes([0xa9, 0x14]), 20, bytes([0x87]))
+DEST_TEMPLATES = {
+    'p2wpkh': (bytes([0, 20]), 20, b''),
+    'p2wsh': (bytes([0, 32]), 32, b''),
+    # OP_1 = int(81)
+    'p2tr': (bytes([81, 32]), 32, b''),
+    # all equally bogus P2SH outputs
+    'p2sh': _P2SH_DEST,
+    'p2wsh-p2sh': _P2SH_DEST,
+    'p2wpkh-p2sh': _P2SH_DEST,
+    'p2sh-p2wsh': _P2SH_DEST,
+    'p2sh-p2wpkh': _P2SH_DEST,
+    'p2pkh': (bytes([0x76, 0xa9, 0x14]), 20, bytes([0x88, 0xac])),
+    # missing: 'p2pk' =>  pay to pubkey, considered obsolete
+}
+
+def fake_dest_addrs(styles, count=None, rng=random):
+    # Make many plausible output addresses at once, from one bulk random draw.
+    # - styles: list of styles, one per output; or single style and count
+    # - rng: see make_rng()
+    # - cant use for change outs
+    if isinstance(styles, str):
+        styles = [styles] * (count or 0)
+
+    try:
+        templates = [DEST_TEMPLATES[st] for st in styles]
+    except KeyError as exc:
+        raise ValueError('not supported: ' + exc.args[0])
+
+    rnd = prandom(sum(ln for _, ln, _ in templates), rng)
+
+    rv = []
+    pos = 0
+    for prefix, ln, suffix in templates:
+        rv.append(prefix + rnd[pos:pos+ln] + suffix)
+        pos += ln
+
+    return rv
+
+def fake_dest_addr(style='p2pkh', rng=random):
     # Make a plausible output address, but it's random garbage. Cant use for change outs
+    return fake_dest_addrs([style], rng=rng)[0]
 
-    # See CTxOut.get_address() in ../shared/serializations
-
-    if style == 'p2wpkh':
-        return bytes([0, 20]) + prandom(20)
-
-    if style == 'p2wsh':
-        return bytes([0, 32]) + prandom(32)
-
-    if style == 'p2tr':
-        # OP_1 = int(81)
-        return bytes([81, 32]) + prandom(32)
-
-    if style in ['p2sh', 'p2wsh-p2sh', 'p2wpkh-p2sh', 'p2sh-p2wsh', 'p2sh-p2wpkh']:
-        # all equally bogus P2SH outputs
-        return bytes([0xa9, 0x14]) + prandom(20) + bytes([0x87])
-
-    if style == 'p2pkh':
-        return bytes([0x76, 0xa9, 0x14]) + prandom(20) + bytes([0x88, 0xac])
-
-    # missing: if style == 'p2pk' =>  pay to pubkey, considered obsolete
-
-    raise ValueError('not supported: ' + style)
-
-def make_change_addr(master_xfp, orig_der,  account_key, idx, style):
+def make_change_addr(wallet, idx, style):
     # provide script, pubkey and xpath for a legit-looking change output
+    # - wallet: WalletContext
 
     redeem_scr, actual_scr = None, None
 
-    if orig_der:
-        path = str2path(master_xfp, f"{orig_der}/0/{idx}")
-    else:
-        path = str2path(master_xfp, f"0/{idx}")
-
-    dest = account_key.subkey_for_path(f"0/{idx}")
-
-    target = dest.hash160()
+    sec, target, path = wallet.receive_key(idx)
     assert len(target) == 20
 
     is_segwit = False
@@ -76,57 +102,48 @@ def make_change_addr(master_xfp, orig_der,  account_key, idx, style):
     else:
         raise ValueError('cant make fake change output of type: ' + style)
 
-    return redeem_scr, actual_scr, is_segwit, dest.sec(), path
+    return redeem_scr, actual_scr, is_segwit, sec, path
+
+
+def section_sinks(psbt, out_fd=None):
+    # where finished input/output sections go: kept in psbt, or streamed into out_fd
+    # - when streaming, v2 globals must be final by now
+    if out_fd is None:
+        return None, psbt.inputs.append, psbt.outputs.append
 
+    writer = PSBTStreamWriter(out_fd, psbt)
+    return writer, writer.add, writer.add
+
+def finish_psbt(psbt, writer=None):
+    # serialized PSBT, or None if it has been streamed already
+    if writer:
+        writer.finish()
+        return None
+
+    return psbt.as_bytes()
+
+def single_sig_af(segwit_in=False, wrapped=False):
+    # address format of the inputs (and default outputs) for single-signer PSBT
+    return ("p2sh-p2wpkh" if wrapped else "p2wpkh") if segwit_in else "p2pkh"
 
 def fake_txn(num_ins, num_outs, master_xpub=None, fee=10000,
          outvals=None, segwit_in=False, wrapped=False, outstyles=None,
          change_outputs=[], op_return=None, psbt_v2=None, input_amount=1E8,
-         locktime=0, sequences=None, is_testnet=False, partial=False):
-
-    af = ("p2sh-p2wpkh" if wrapped else "p2wpkh") if segwit_in else "p2pkh"
-
-    # we have a key; use it to provide "plausible" value inputs
-    orig_der = None
-    if master_xpub:
-        master_xpub = master_xpub.strip()  # annoying whitespaces
-        key_orig_info = None
-        close_idx = master_xpub.find("]")
-        if master_xpub[0] == "[" and (close_idx != -1):
-            # key has origin derivation public - parse
-            key_orig_info = master_xpub[1:close_idx]
-            master_xpub = master_xpub[close_idx + 1:]
-
-        account_key = BIP32Node.from_wallet_key(master_xpub)
-        if key_orig_info:
-            split_der = key_orig_info.split("/", 1)
-            if len(split_der) == 1:
-                str_xfp = split_der[0]
-                orig_der = None
-            else:
-                str_xfp, orig_der = split_der
+         locktime=0, sequences=None, is_testnet=False, partial=False, wallet=None,
+         out_fd=None, seed=None):
+    # returns PSBT bytes and summary of outputs: [(amount, address, is_change), ...]
+    # - summary is an OutputsSummary: addresses are only rendered when looked at
+    # - with out_fd, PSBT is written there as it is built and None is returned instead of bytes
+    # - seed: int or random.Random, makes output reproducible; see make_rng()
+    # - wallet: WalletContext to use instead of master_xpub
 
-            xfp = bytes.fromhex(str_xfp)
+    # phase timing, see timing.py; does nothing unless profiling
+    lap = timing.active.lap
 
-        else:
-            xfp = account_key.fingerprint()
-            try:
-                assert account_key.privkey() is not None
-                # user provided extended private key, we can simulate proper hardened derivations
-                if af == "p2wpkh":
-                    purpose = 84
-                elif af == "p2sh-p2wpkh":
-                    purpose = 49
-                else:
-                    purpose = 44
+    af = single_sig_af(segwit_in, wrapped)
 
-                orig_der = f"{purpose}h/{int(is_testnet)}h/0h"
-                account_key = account_key.subkey_for_path(orig_der)
-            except: pass
-    else:
-        # special value for COLDCARD: zero xfp => anyone can try to sign
-        account_key = BIP32Node.from_master_secret(b'1' * 32)
-        xfp = bytes(4)
+    if wallet is None:
+        wallet = wallet_for(master_xpub, af=af, is_testnet=is_testnet)
 
     psbt = BasicPSBT()
 
@@ -134,67 +151,70 @@ def fake_txn(num_ins, num_outs, master_xpub=None, fee=10000,
         psbt.version = 2
         psbt.txn_version = 2
         psbt.input_count = num_ins
-        psbt.output_count = num_outs
+        psbt.output_count = num_outs + len(op_return or [])
         psbt.fallback_locktime = locktime
 
     txn = CTransaction()
     txn.nVersion = 2
     txn.nLockTime = locktime
 
-    psbt.inputs = [BasicPSBTInput(idx=i) for i in range(num_ins)]
-    psbt.outputs = [BasicPSBTOutput(idx=i) for i in range(num_outs)]
+    writer, add_input, add_output = section_sinks(psbt, out_fd)
 
     outputs = []
 
+    # addr where the fake money will be stored.
+    # always from internal address chain
+    in_keys = wallet.keys(1, 0, num_ins)
+    lap('derive')
+
+    # inputs spend random (fake) txids, so PSBTs of a batch differ even when all
+    # outputs are change; same rng makes the destinations below
+    rng = make_rng(seed)
+    supply_txids = prandom(32 * num_ins, rng)
+
     for i in range(num_ins):
         # make a fake txn to supply each of the inputs
-        # addr where the fake money will be stored.
-        # always from internal address chain
-        subder = f"1/{i}"
-        subkey = account_key.subkey_for_path(subder)
-        sec = subkey.sec()
+        sec, sec_h160, dp = in_keys[i]
         assert len(sec) == 33, "expect compressed"
 
+        inp = BasicPSBTInput(idx=i)
+
         if partial and (i == 0):
-            psbt.inputs[i].bip32_paths[sec] = b'Nope' + struct.pack('<II', 1, i)
+            inp.bip32_paths[sec] = b'Nope' + struct.pack('<II', 1, i)
         else:
-            if orig_der:
-                dp = str2path(xfp.hex(), f"{orig_der}/{subder}")
-            else:
-                dp = str2path(xfp.hex(), subder)
-
-            psbt.inputs[i].bip32_paths[sec] = dp
+            inp.bip32_paths[sec] = dp
 
         # UTXO that provides the funding for to-be-signed txn
         supply = CTransaction()
         supply.nVersion = 2
-        out_point = COutPoint(
-            uint256_from_str(struct.pack('4Q', 0xdead, 0xbeef, 0, 0)),
-            73
-        )
+        out_point = COutPoint(uint256_from_str(supply_txids[32*i:32*(i+1)]), 73)
         supply.vin = [CTxIn(out_point, nSequence=0xffffffff)]
 
         if segwit_in:
             # p2wpkh
-            scr = bytes([0x00, 0x14]) + subkey.hash160()
+            scr = bytes([0x00, 0x14]) + sec_h160
             if wrapped:
                 # p2sh-p2wpkh
-                psbt.inputs[i].redeem_script = scr
+                inp.redeem_script = scr
                 scr = bytes([0xa9, 0x14]) + hash160(scr) + bytes([0x87])
         else:
             # p2pkh
-            scr = bytes([0x76, 0xa9, 0x14]) + subkey.hash160() + bytes([0x88, 0xac])
+            scr = bytes([0x76, 0xa9, 0x14]) + sec_h160 + bytes([0x88, 0xac])
 
         supply.vout.append(CTxOut(int(input_amount), scr))
 
+        # supply has no witness: whole tx is also what its txid is hashed from
+        raw = None
         if segwit_in:
             # just utxo for segwit
-            psbt.inputs[i].witness_utxo = supply.vout[-1].serialize()
+            inp.witness_utxo = supply.vout[-1].serialize()
         else:
             # whole tx for pre-segwit
-            psbt.inputs[i].utxo = supply.serialize_with_witness()
+            inp.utxo = raw = supply.serialize_with_witness()
 
-        supply.calc_sha256()
+        lap('inputs')
+        supply.calc_sha256(raw=raw)
+        lap('hash')
 
         seq = None
         if sequences:
@@ -210,41 +230,50 @@ def fake_txn(num_ins, num_outs, master_xpub=None, fee=10000,
                 seq = 0xfffffffe
 
         if psbt_v2:
-            psbt.inputs[i].previous_txid = supply.hash
-            psbt.inputs[i].prevout_idx = 0
-            psbt.inputs[i].sequence = seq
+            inp.previous_txid = supply.hash
+            inp.prevout_idx = 0
+            inp.sequence = seq
             if locktime:
                 # no need to do this as fallback locktime is already set in globals but yolo
                 if locktime < 500000000:
-                    psbt.inputs[i].req_height_locktime = locktime
+                    inp.req_height_locktime = locktime
                 else:
-                    psbt.inputs[i].req_time_locktime = locktime
+                    inp.req_time_locktime = locktime
 
 
         spendable = CTxIn(COutPoint(supply.sha256, 0), nSequence=seq)
         txn.vin.append(spendable)
+        add_input(inp)
+
+    if not outstyles:
+        styles = [af] * num_outs
+    elif len(outstyles) == 1:
+        styles = outstyles * num_outs
+    elif len(outstyles) == num_outs:
+        styles = outstyles
+    else:
+        styles = [outstyles[i % len(outstyles)] for i in range(num_outs)]
+
+    # all the random destinations, in one go
+    dests = iter(fake_dest_addrs([st for i, st in enumerate(styles)
+                                  if i not in change_outputs], rng=rng))
+    lap('destinations')
 
     for i in range(num_outs):
-        if not outstyles:
-            style = af
-        elif len(outstyles) == 1:
-            style = outstyles[0]
-        elif len(outstyles) == num_outs:
-            style = outstyles[i]
-        else:
-            style = outstyles[i % len(outstyles)]
+        style = styles[i]
+
+        out = BasicPSBTOutput(idx=i)
 
         if i in change_outputs:
-            scr, act_scr, isw, pubkey, sp = make_change_addr(xfp.hex(), orig_der,
-                                                             account_key, i, style)
+            scr, act_scr, isw, pubkey, sp = make_change_addr(wallet, i, style)
 
             if len(pubkey) == 32:  # xonly
-                psbt.outputs[i].taproot_bip32_paths[pubkey] = sp
+                out.taproot_bip32_paths[pubkey] = sp
             else:
-                psbt.outputs[i].bip32_paths[pubkey] = sp
+                out.bip32_paths[pubkey] = sp
 
         else:
-            scr = act_scr = fake_dest_addr(style)
+            scr = act_scr = next(dests)
             isw = ('w' in style)
 
         assert scr
@@ -252,13 +281,13 @@ def fake_txn(num_ins, num_outs, master_xpub=None, fee=10000,
 
         # one of these is not needed anymore in v2 as you have scriptPubkey provided by self.script
         if "p2sh" in style:  # in ('p2sh-p2wpkh', 'p2wpkh-p2sh'):
-            psbt.outputs[i].redeem_script = scr
+            out.redeem_script = scr
         elif isw:
-            psbt.outputs[i].witness_script = scr
+            out.witness_script = scr
 
         if psbt_v2:
-            psbt.outputs[i].script = act_scr
-            psbt.outputs[i].amount = int(
+            out.script = act_scr
+            out.amount = int(
                 outvals[i] if outvals else round(((input_amount * num_ins) - fee) / num_outs, 4))
 
         if not outvals:
@@ -269,10 +298,11 @@ def fake_txn(num_ins, num_outs, master_xpub=None, fee=10000,
         outputs.append((h.nValue, act_scr, (i in change_outputs)))
 
         txn.vout.append(h)
+        add_output(out)
 
     # op_return is a tuple of (amount, data)
     if op_return:
-        for op_ret in op_return:
+        for k, op_ret in enumerate(op_return):
             amount, data = op_ret
             op_return_size = len(data)
             if op_return_size < 76:
@@ -280,76 +310,97 @@ def fake_txn(num_ins, num_outs, master_xpub=None, fee=10000,
             else:
                 script = bytes([106, 76, op_return_size]) + data
 
-            op_ret_o = BasicPSBTOutput(idx=len(psbt.outputs))
+            op_ret_o = BasicPSBTOutput(idx=num_outs + k)
             if psbt_v2:
                 op_ret_o.script = script
                 op_ret_o.amount = amount
-                psbt.output_count += 1
             else:
                 op_return_out = CTxOut(amount, script)
                 txn.vout.append(op_return_out)
 
-            psbt.outputs.append(op_ret_o)
+            add_output(op_ret_o)
+
+    lap('outputs')
 
     if not psbt_v2:
         psbt.txn = txn.serialize_with_witness()
 
-    rv = BytesIO()
-    psbt.serialize(rv)
+    rv = finish_psbt(psbt, writer)
+    lap('serialize')
 
-    return rv.getvalue(), [(n, render_address(s, is_testnet), ic) for n,s,ic in outputs]
+    return rv, OutputsSummary(outputs, is_testnet)
 
 
-def make_redeem(M, keys, idx, is_change, bip67=True):
+def cosigner_pubkeys(keys, chain, start, count):
+    # [[pubkey of each cosigner], ...] for chain/start .. chain/start+count-1,
+    # each cosigner's keys derived in one batch
+    per_key = [[n.sec() for n in node.subkey_for_path(str(chain)).derive_children(start, count)]
+               for _, _, node in keys]
+    return [list(pks) for pks in zip(*per_key)]
+
+def make_redeem(M, keys, idx, is_change, bip67=True, pubkeys=None):
     # Construct a redeem script, and ordered list of xfp+path to match.
-    N = len(keys)
+    # - pubkeys: cosigner keys for idx if already derived, see cosigner_pubkeys()
 
     # see BIP 67: <https://github.com/bitcoin/bips/blob/master/bip-0067.mediawiki>
 
     data = []
     for cosigner_idx, (xfp, str_path, node) in enumerate(keys):
         sp = f"{int(is_change)}/{idx}"
-        n = node.subkey_for_path(sp)
-        pk = n.sec()
+        if pubkeys:
+            pk = pubkeys[cosigner_idx]
+        else:
+            pk = node.subkey_for_path(sp).sec()
         data.append((pk, str2path(xfp, str_path + "/" + sp)))
 
     if bip67:
         data.sort(key=lambda i: i[0])
 
+    return multisig_script(M, [pk for pk, _ in data]), data
+
+def multisig_script(M, pubkeys):
+    # M-of-N CHECKMULTISIG script, pubkeys already in final order
+    N = len(pubkeys)
+
     mm = [80 + M] if M <= 16 else [1, M]
     nn = [80 + N] if N <= 16 else [1, N]
 
     rv = bytes(mm)
 
-    for pk, _ in data:
+    for pk in pubkeys:
         rv += bytes([len(pk)]) + pk
 
     rv += bytes(nn + [0xAE])
 
-    return rv, data
+    return rv
+
+def ms_script_pubkey(script, addr_fmt="p2wsh"):
+    # scriptPubKey that pays to a multisig (witness or redeem) script
+    if addr_fmt == "p2wsh":
+        return bytes([0x0, 0x20]) + hashlib.sha256(script).digest()
+
+    if addr_fmt == "p2sh":
+        digest = hash160(script)
+    elif addr_fmt in ("p2sh-p2wsh", "p2wsh-p2sh"):
+        digest = hash160(b'\x00\x20' + hashlib.sha256(script).digest())
+    else:
+        raise ValueError(addr_fmt)
+
+    return bytes([0xa9, 0x14]) + digest + bytes([0x87])
 
 def make_ms_address(M, keys, idx, is_change, addr_fmt="p2wsh", testnet=1, bip67=True):
     # Construct addr and script need to represent a p2sh address
     script, bip32paths = make_redeem(M, keys, idx, is_change, bip67=bip67)
 
+    scriptPubKey = ms_script_pubkey(script, addr_fmt)
+
     if addr_fmt == "p2wsh":
         # testnet=2 --> regtest
         hrp = ['bc', 'tb', 'bcrt'][testnet]
-        data = hashlib.sha256(script).digest()
-        addr = bech32_encode(hrp, 0, data)
-        scriptPubKey = bytes([0x0, 0x20]) + data
+        addr = bech32_encode(hrp, 0, scriptPubKey[2:], trusted=True)
     else:
-        if addr_fmt == "p2sh":
-            digest = hash160(script)
-        elif addr_fmt in ("p2sh-p2wsh", "p2wsh-p2sh"):
-            digest = hash160(b'\x00\x20' + hashlib.sha256(script).digest())
-        else:
-            raise ValueError(addr_fmt)
-
         prefix = bytes([196]) if testnet else bytes([5])
-        addr = encode_base58_checksum(prefix + digest)
-
-        scriptPubKey = bytes([0xa9, 0x14]) + digest + bytes([0x87])
+        addr = encode_base58_checksum(prefix + scriptPubKey[2:22])
 
     return addr, scriptPubKey, script, bip32paths
 
@@ -357,10 +408,16 @@ def make_ms_address(M, keys, idx, is_change, addr_fmt="p2wsh", testnet=1, bip67=
 def fake_ms_txn(num_ins, num_outs, M, keys, fee=10000, outvals=None,
                 outstyles=['p2wsh'], change_outputs=[], incl_xpubs=False,
                 input_amount=1E8, bip67=True, locktime=0, psbt_v2=False,
-                sequences=None, is_testnet=False, change_af=None):
+                sequences=None, is_testnet=False, change_af=None, out_fd=None,
+                seed=None, addr_index=None):
     # make various size MULTISIG txn's ... completely fake and pointless values
     # - but has UTXO's to match needs
+    # - seed: see fake_txn()
+    # - addr_index: multisig.MultisigAddressIndex for this wallet, saves deriving addresses
     # spending change outputs
+    # - with out_fd, PSBT is written there as it is built and None is returned instead of bytes
+    lap = timing.active.lap
+
     psbt = BasicPSBT()
 
     if psbt_v2:
@@ -380,8 +437,31 @@ def fake_ms_txn(num_ins, num_outs, M, keys, fee=10000, outvals=None,
             kk = str2path(xfp, str_path)
             psbt.xpubs.append((node.node.serialize_public(), kk))
 
-    psbt.inputs = [BasicPSBTInput(idx=i) for i in range(num_ins)]
-    psbt.outputs = [BasicPSBTOutput(idx=i) for i in range(num_outs)]
+    writer, add_input, add_output = section_sinks(psbt, out_fd)
+
+    if addr_index:
+        from .multisig import config_fingerprint
+        assert addr_index.fingerprint == config_fingerprint(M, keys, change_af, bip67), \
+            'address index is for another wallet'
+
+    def ms_address(idx, is_change, pubkeys=None):
+        # (scriptPubKey, script, details) from index when there, else derived
+        rv = addr_index and addr_index.get(idx, is_change)
+        if not rv:
+            # not make_ms_address(): address string would not be used
+            script, details = make_redeem(M, keys, idx, is_change, bip67=bip67,
+                                          pubkeys=pubkeys)
+            rv = ms_script_pubkey(script, change_af), script, details
+        return rv
+
+    in_pubkeys = None
+    if num_ins and not (addr_index and addr_index.count >= num_ins):
+        in_pubkeys = cosigner_pubkeys(keys, 1, 0, num_ins)
+    lap('derive')
+
+    # random (fake) txids being spent, see fake_txn()
+    rng = make_rng(seed)
+    supply_txids = prandom(32 * num_ins, rng)
 
     for i in range(num_ins):
         # make a fake txn to supply each of the inputs
@@ -389,35 +469,35 @@ def fake_ms_txn(num_ins, num_outs, M, keys, fee=10000, outvals=None,
 
         # addr where the fake money will be stored.
         # always same address format as config defines
-        addr, scriptPubKey, script, details = make_ms_address(M, keys, i, True,
-                                                              addr_fmt=change_af,
-                                                              bip67=bip67)
+        scriptPubKey, script, details = ms_address(i, True, in_pubkeys and in_pubkeys[i])
+        inp = BasicPSBTInput(idx=i)
         if "p2wsh" in change_af:
-            psbt.inputs[i].witness_script = script
+            inp.witness_script = script
 
         if "p2sh" in change_af:
-            psbt.inputs[i].redeem_script = script
+            inp.redeem_script = script
 
         for pubkey, xfp_path in details:
-            psbt.inputs[i].bip32_paths[pubkey] = xfp_path
+            inp.bip32_paths[pubkey] = xfp_path
 
         # UTXO that provides the funding for to-be-signed txn
         supply = CTransaction()
         supply.nVersion = 2
-        out_point = COutPoint(
-            uint256_from_str(struct.pack('4Q', 0xdead, 0xbeef, 0, 0)),
-            73
-        )
+        out_point = COutPoint(uint256_from_str(supply_txids[32*i:32*(i+1)]), 73)
         supply.vin = [CTxIn(out_point, nSequence=0xffffffff)]
 
         supply.vout.append(CTxOut(int(input_amount), scriptPubKey))
 
+        # supply has no witness: whole tx is also what its txid is hashed from
+        raw = None
         if "wsh" in change_af:
-            psbt.inputs[i].utxo = supply.serialize_with_witness()
+            inp.utxo = raw = supply.serialize_with_witness()
         else:
-            psbt.inputs[i].witness_utxo = supply.vout[-1].serialize()
+            inp.witness_utxo = supply.vout[-1].serialize()
 
-        supply.calc_sha256()
+        lap('inputs')
+        supply.calc_sha256(raw=raw)
+        lap('hash')
 
         seq = None
         if sequences:
@@ -434,56 +514,66 @@ def fake_ms_txn(num_ins, num_outs, M, keys, fee=10000, outvals=None,
                 seq = 0xfffffffe
 
         if psbt_v2:
-            psbt.inputs[i].previous_txid = supply.hash
-            psbt.inputs[i].prevout_idx = 0
-            psbt.inputs[i].sequence = seq
+            inp.previous_txid = supply.hash
+            inp.prevout_idx = 0
+            inp.sequence = seq
             if locktime:
                 # no need to do this as fallback locktime is already set in globals but yolo
                 if locktime < 500000000:
-                    psbt.inputs[i].req_height_locktime = locktime
+                    inp.req_height_locktime = locktime
                 else:
-                    psbt.inputs[i].req_time_locktime = locktime
+                    inp.req_time_locktime = locktime
 
         spendable = CTxIn(COutPoint(supply.sha256, 0), nSequence=seq)
         txn.vin.append(spendable)
+        add_input(inp)
+
+    # random destinations for all non-change outputs, in one go
+    dest_styles = []
+    for i in range(num_outs):
+        if i in change_outputs:
+            continue
+        if not outstyles:
+            # make same outstyles as instyles
+            style = change_af
+        elif len(outstyles) == 1:
+            style = outstyles[0]
+        elif len(outstyles) == num_outs:
+            style = outstyles[i-len(change_outputs)]
+        else:
+            style = outstyles[(i-len(change_outputs)) % len(outstyles)]
+        dest_styles.append(style)
+
+    dests = iter(fake_dest_addrs(dest_styles, rng=rng))
+    lap('destinations')
 
     outputs = []
     for i in range(num_outs):
+        out = BasicPSBTOutput(idx=i)
         if i in change_outputs:
             # change outputs are always same as multisig address format
-            addr, scriptPubKey, scr, details = make_ms_address(M, keys, num_ins+i, False,
-                                                               addr_fmt=change_af, bip67=bip67)
+            scriptPubKey, scr, details = ms_address(num_ins+i, False)
 
             for pubkey, xfp_path in details:
-                psbt.outputs[i].bip32_paths[pubkey] = xfp_path
+                out.bip32_paths[pubkey] = xfp_path
 
             if 'w' in change_af:
-                psbt.outputs[i].witness_script = scr
+                out.witness_script = scr
                 if change_af.endswith('p2sh'):
-                    psbt.outputs[i].redeem_script = b'\0\x20' + hashlib.sha256(scr).digest()
+                    out.redeem_script = b'\0\x20' + hashlib.sha256(scr).digest()
             elif change_af.endswith('sh'):
-                psbt.outputs[i].redeem_script = scr
+                out.redeem_script = scr
         else:
-            if not outstyles:
-                # make same outstyles as instyles
-                style = change_af
-            elif len(outstyles) == 1:
-                style = outstyles[0]
-            elif len(outstyles) == num_outs:
-                style = outstyles[i-len(change_outputs)]
-            else:
-                style = outstyles[(i-len(change_outputs)) % len(outstyles)]
-
-            scriptPubKey = fake_dest_addr(style)
+            scriptPubKey = next(dests)
 
         assert scriptPubKey
 
         if psbt_v2:
-            psbt.outputs[i].script = scriptPubKey
+            out.script = scriptPubKey
             if outvals:
-                psbt.outputs[i].amount = outvals[i]
+                out.amount = outvals[i]
             else:
-                psbt.outputs[i].amount = int(round(((input_amount * num_ins) - fee) / num_outs, 4))
+                out.amount = int(round(((input_amount * num_ins) - fee) / num_outs, 4))
 
 
         if not outvals:
@@ -492,16 +582,53 @@ def fake_ms_txn(num_ins, num_outs, M, keys, fee=10000, outvals=None,
             h = CTxOut(int(outvals[i]), scriptPubKey)
 
         txn.vout.append(h)
+        add_output(out)
 
         outputs.append((h.nValue, scriptPubKey, (i in change_outputs)))
 
+    lap('outputs')
+
     if not psbt_v2:
         psbt.txn = txn.serialize_with_witness()
 
-    rv = BytesIO()
-    psbt.serialize(rv)
+    rv = finish_psbt(psbt, writer)
+    lap('serialize')
+
+    return rv, OutputsSummary(outputs, is_testnet)
 
-    return rv.getvalue(), [(n, render_address(s, is_testnet), ic) for n,s,ic in outputs]
+class OutputsSummary(Sequence):
+    # [(amount, address, is_change), ...] for the outputs of a fake txn, but the
+    # address strings are only made (bech32/base58) when an item is accessed.
+    # - scripts: same list with scriptPubKey in place of address, nothing to render
+
+    def __init__(self, scripts, testnet=False):
+        self.scripts = scripts
+        self.testnet = testnet
+        self._rendered = {}
+
+    def __len__(self):
+        return len(self.scripts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self.scripts)
+
+        rv = self._rendered.get(idx)
+        if rv is None:
+            amount, script, is_change = self.scripts[idx]
+            rv = self._rendered[idx] = (amount, render_address(script, self.testnet), is_change)
+        return rv
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
 
 def render_address(script, testnet=True):
     # take a scriptPubKey (part of the TxOut) and convert into conventional human-readable
@@ -527,14 +654,70 @@ def render_address(script, testnet=True):
     if ll == 23 and script[0:2] == b'\xA9\x14' and script[22] == 0x87:
         return encode_base58_checksum(b58_script + script[2:2+20])
 
-    # segwit v0 (P2WPKH, P2WSH)
+    # segwit v0 (P2WPKH, P2WSH); shape checked here, so no need for round-trip check
     if script[0] == 0 and script[1] in (0x14, 0x20) and (ll - 2) == script[1]:
-        return bech32_encode(bech32_hrp, script[0], script[2:])
+        return bech32_encode(bech32_hrp, script[0], script[2:], trusted=True)
 
     # segwit v1 (P2TR) and later segwit version OP_1 .. OP_16
     if ll == 34 and (81 <= script[0] <= 96) and script[1] == 0x20:
-        return bech32_encode(bech32_hrp, script[0] - 80, script[2:])
+        return bech32_encode(bech32_hrp, script[0] - 80, script[2:], trusted=True)
 
     raise ValueError('Unknown payment script', repr(script))
 
+
+class TestStreaming(unittest.TestCase):
+    # out_fd: PSBT written while it is built must be the same as the one made in memory
+    #   python3 -m unittest psbt_faker.txn
+
+    def check(self, func, *args, **kws):
+        psbt, outs = func(*args, seed=5, **kws)
+        fd = io.BytesIO()
+        rv, streamed_outs = func(*args, seed=5, out_fd=fd, **kws)
+        self.assertIsNone(rv)
+        self.assertEqual(fd.getvalue(), bytes(psbt))
+        self.assertEqual(list(streamed_outs), list(outs))
+        return BasicPSBT().parse(fd.getvalue())
+
+    def test_single_sig(self):
+        from . import SIM_XPUB
+        for v2 in (False, True):
+            for segwit, wrapped in [(False, False), (True, False), (True, True)]:
+                with self.subTest(v2=v2, segwit=segwit, wrapped=wrapped):
+                    self.check(fake_txn, 3, 3, SIM_XPUB, segwit_in=segwit, wrapped=wrapped,
+                               psbt_v2=v2, change_outputs=[0], locktime=5)
+
+    def test_op_return(self):
+        # v2 globals (output count) go out first, before the OP_RETURN outputs are made
+        from . import SIM_XPUB
+        ops = [(0, b'hi'), (1000, b'x' * 80)]
+        for v2 in (False, True):
+            with self.subTest(v2=v2):
+                p = self.check(fake_txn, 2, 3, SIM_XPUB, segwit_in=True, psbt_v2=v2,
+                               change_outputs=[0], op_return=ops)
+                self.assertEqual(len(p.outputs), 3 + len(ops))
+                if v2:
+                    self.assertEqual(p.output_count, 3 + len(ops))
+                else:
+                    self.assertEqual(len(p.parsed_txn.vout), 3 + len(ops))
+
+    def test_multisig(self):
+        from .multisig import _test_wallet
+        for af in ('p2wsh', 'p2sh', 'p2sh-p2wsh'):
+            af, keys, M = _test_wallet(af)
+            for v2 in (False, True):
+                with self.subTest(af=af, v2=v2):
+                    self.check(fake_ms_txn, 3, 3, M, keys, change_af=af, change_outputs=[0],
+                               psbt_v2=v2, incl_xpubs=True)
+
+    def test_spool(self):
+        # v0 sections parked on disk when past spool_size: same bytes
+        from . import SIM_XPUB
+        p = BasicPSBT().parse(fake_txn(20, 5, SIM_XPUB, change_outputs=[0], seed=5)[0])
+        fd = io.BytesIO()
+        wr = PSBTStreamWriter(fd, p, spool_size=64)
+        for section in list(p.inputs) + list(p.outputs):
+            wr.add(section)
+        wr.finish()
+        self.assertEqual(fd.getvalue(), p.as_bytes())
+
 # EOF
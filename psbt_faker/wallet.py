@@ -0,0 +1,111 @@
+#
+# Single-signer wallet for fake_txn(): parsed once, keys derived once.
+#
+import struct
+from functools import lru_cache
+from .bip32 import BIP32Node
+from .helpers import str2path
+
+
+class WalletContext:
+    # Account key, its master fingerprint and derivation, plus tables of keys
+    # used so far on the external (0/*) and internal (1/*) chains.
+    # Each table entry is (sec, hash160, bip32 path bytes), filled on first use.
+
+    def __init__(self, account_key, xfp, orig_der=None):
+        self.account_key = account_key
+        self.xfp = xfp
+        self.orig_der = orig_der
+
+        # path of the account key itself; chain/idx get added
+        self.path_prefix = str2path(xfp.hex(), orig_der or '')
+
+        self.chain_keys = [None, None]
+        self.tables = ([], [])
+
+    @classmethod
+    def from_xpub(cls, master_xpub=None, af="p2pkh", is_testnet=False):
+        # parse "[xfp/deriv]xpub" (or xprv)
+        # - we have a key; use it to provide "plausible" value inputs
+        orig_der = None
+        if master_xpub:
+            master_xpub = master_xpub.strip()  # annoying whitespaces
+            key_orig_info = None
+            close_idx = master_xpub.find("]")
+            if master_xpub[0] == "[" and (close_idx != -1):
+                # key has origin derivation public - parse
+                key_orig_info = master_xpub[1:close_idx]
+                master_xpub = master_xpub[close_idx + 1:]
+
+            account_key = BIP32Node.from_wallet_key(master_xpub)
+            if key_orig_info:
+                split_der = key_orig_info.split("/", 1)
+                if len(split_der) == 1:
+                    str_xfp = split_der[0]
+                    orig_der = None
+                else:
+                    str_xfp, orig_der = split_der
+
+                xfp = bytes.fromhex(str_xfp)
+
+            else:
+                xfp = account_key.fingerprint()
+                try:
+                    assert account_key.privkey() is not None
+                    # user provided extended private key, we can simulate proper hardened derivations
+                    if af == "p2wpkh":
+                        purpose = 84
+                    elif af == "p2sh-p2wpkh":
+                        purpose = 49
+                    else:
+                        purpose = 44
+
+                    orig_der = f"{purpose}h/{int(is_testnet)}h/0h"
+                    account_key = account_key.subkey_for_path(orig_der)
+                except: pass
+        else:
+            # special value for COLDCARD: zero xfp => anyone can try to sign
+            account_key = BIP32Node.from_master_secret(b'1' * 32)
+            xfp = bytes(4)
+
+        return cls(account_key, xfp, orig_der)
+
+    def key(self, chain, idx):
+        # (sec, hash160, path) of key chain/idx under the account
+        table = self.tables[chain]
+        rv = table[idx] if idx < len(table) else None
+        return rv or self.keys(chain, idx, 1)[0]
+
+    def keys(self, chain, start, count):
+        # [(sec, hash160, path), ...] of keys chain/start .. chain/start+count-1;
+        # missing ones are derived in one batch
+        table = self.tables[chain]
+        end = start + count
+        if end > len(table):
+            table.extend([None] * (end - len(table)))
+
+        missing = [idx for idx in range(start, end) if table[idx] is None]
+        if missing:
+            ck = self.chain_keys[chain]
+            if ck is None:
+                ck = self.chain_keys[chain] = self.account_key.subkey_for_path(str(chain))
+
+            lo, hi = missing[0], missing[-1] + 1
+            for idx, node in zip(range(lo, hi), ck.derive_children(lo, hi - lo)):
+                table[idx] = (node.sec(), node.hash160(),
+                              self.path_prefix + struct.pack('<II', chain, idx))
+        return table[start:end]
+
+    def receive_key(self, idx):
+        return self.key(0, idx)
+
+    def change_key(self, idx):
+        return self.key(1, idx)
+
+
+@lru_cache(maxsize=32)
+def wallet_for(master_xpub=None, af="p2pkh", is_testnet=False):
+    # shared WalletContext per key string, so repeated calls don't parse (or derive) again
+    return WalletContext.from_xpub(master_xpub, af=af, is_testnet=is_testnet)
+
+# EOF
@@ -28,6 +28,9 @@ if __name__ == '__main__':
             'Click',
             'ecdsa',
         ],
+        extras_require={
+            'fast': ['coincurve'],
+        },
         entry_points='''
             [console_scripts]
             psbt_faker=psbt_faker:main